@@ -1,31 +1,290 @@
 import asyncio
 import logging
+import time
+from typing import Awaitable, Optional, Tuple
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import BOT_TOKEN, LOGS_DIR
+from config import (
+    BOT_TOKEN, LOGS_DIR,
+    BOT_MODE, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_REUSE_PORT,
+    WEBHOOK_SET_ON_STARTUP, WEBHOOK_DROP_PENDING_UPDATES,
+    RATE_LIMIT_MESSAGES, RATE_LIMIT_MESSAGES_PERIOD, RATE_LIMIT_CALLBACKS, RATE_LIMIT_CALLBACKS_PERIOD,
+    RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_BURST,
+    SCHEDULER_MAX_IN_FLIGHT, SCHEDULER_MAX_QUEUED_PER_USER, SCHEDULER_MAX_QUEUED,
+    CATALOG_SYNC_ON_STARTUP, STARTUP_STEP_TIMEOUT, SHUTDOWN_DRAIN_TIMEOUT,
+    METRICS_ENABLED, METRICS_PORT,
+)
 from handlers import start as start_handler, catalog as catalog_handler, payment as payment_handler, admin as admin_handler
-from middlewares.ratelimit import RateLimitMiddleware
+from middlewares.ratelimit import RateLimitMiddleware, TokenBucketLimiter
 from middlewares.bancheck import BanCheckMiddleware
+from middlewares.scheduler import UpdateSchedulerMiddleware
+from middlewares.outbound import telegram_governor
+from middlewares.metrics import HandlerMetricsMiddleware
+from database.ban_list import ban_list
+from database.catalog_cache import catalog_cache
+from database.supabase_http_client import supabase_http_client
+from database.write_behind import write_behind
+from database.shared_state import shared_state
 
+from utils.executor import blocking_executor
+from utils.encryption import encryptor
+from utils.fulfillment import fulfillment
+from utils.invite_pool import invite_pool
+from utils.broadcast import broadcaster
+from utils.catalog_sync import catalog_sync
+from utils.cards import card_cache
+from utils.pricing import price_service, get_current_price
+from utils.watermark import get_watermark_template, warm_watermark_templates
+from utils.metrics import metrics, metrics_server, metric_family
 from utils.logger import setup_logger
 
+async def run_polling(bot: Bot, dp: Dispatcher):
+    """
+    Receives updates with long polling.
+    """
+    # Updates that arrived while the bot was down are kept, so no successful payment is lost
+    await bot.delete_webhook(drop_pending_updates=WEBHOOK_DROP_PENDING_UPDATES)
+    await dp.start_polling(bot)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Receives updates on an aiohttp webhook endpoint.
+    Telegram gets a 200 as soon as the update is accepted and the update is processed in a background
+    task, so updates are handled concurrently. Several workers can run behind a reverse proxy,
+    each on its own port or on a shared one with WEBHOOK_REUSE_PORT; only one of them should
+    register the webhook (WEBHOOK_SET_ON_STARTUP).
+    """
+    if not WEBHOOK_BASE_URL:
+        raise ValueError("WEBHOOK_BASE_URL must be set to run in webhook mode.")
+    if not WEBHOOK_SECRET:
+        # Without it anyone who can reach the endpoint could post forged updates, fake payments included
+        raise ValueError("WEBHOOK_SECRET must be set to run in webhook mode.")
+
+    async def on_startup(bot: Bot):
+        await bot.set_webhook(
+            url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=WEBHOOK_DROP_PENDING_UPDATES,
+        )
+        logging.info(f"Webhook set to {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+    if WEBHOOK_SET_ON_STARTUP:
+        dp.startup.register(on_startup)
+
+    app = web.Application()
+    # Requests without the matching X-Telegram-Bot-Api-Secret-Token header are rejected
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True).register(app, path=WEBHOOK_PATH)
+    # Runs the dispatcher's startup/shutdown hooks together with the aiohttp app
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT or None)
+    await site.start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        # Serve until the task is cancelled (Ctrl+C / SIGTERM)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def register_metric_collectors(update_scheduler: UpdateSchedulerMiddleware):
+    """
+    Exposes the counters and gauges the bot's components already keep. Read only when metrics are scraped.
+    """
+    def collect_updates():
+        return [
+            *metric_family("bot_updates_in_flight", "gauge", "Updates being processed.", update_scheduler.in_flight),
+            *metric_family("bot_updates_queued", "gauge", "Updates waiting for their turn.", update_scheduler.queued),
+            *metric_family("bot_updates_shed_total", "counter", "Updates dropped under overload.", update_scheduler.shed),
+            *metric_family("bot_banned_users", "gauge", "Users in the in-memory ban list.", ban_list.size),
+        ]
+
+    def collect_backends():
+        executor = blocking_executor.stats()
+        return [
+            *metric_family(
+                "supabase_errors_total", "counter", "Supabase requests given up on, by table or RPC function.",
+                {(target,): count for target, count in supabase_http_client.error_counts.items()}, ("table",),
+            ),
+            *metric_family(
+                "supabase_circuit_open", "gauge", "1 while the Supabase circuit breaker rejects requests.",
+                int(supabase_http_client.circuit_state == "open"),
+            ),
+            *metric_family("executor_queued", "gauge", "Blocking calls waiting for a worker.", executor["queued"]),
+            *metric_family("executor_running", "gauge", "Blocking calls running.", executor["running"]),
+            *metric_family(
+                "executor_calls_total", "counter", "Finished blocking calls by outcome.",
+                {("ok",): executor["completed"], ("error",): executor["failed"]}, ("status",),
+            ),
+            *metric_family("write_behind_pending", "gauge", "Buffered writes not flushed yet.", write_behind.pending),
+        ]
+
+    async def collect_delivery():
+        stats = await fulfillment.stats()
+        governor = telegram_governor.stats()
+        lanes = telegram_governor.lane_stats
+        return [
+            *metric_family("fulfillment_queue_depth", "gauge", "Purchases waiting for or in fulfillment.", stats["depth"]),
+            *metric_family(
+                "fulfillment_jobs_total", "counter", "Fulfillment job runs by outcome.",
+                {
+                    ("completed",): stats["completed"], ("retried",): stats["retried"],
+                    ("failed",): stats["failed"], ("duplicate",): stats["duplicates"],
+                },
+                ("outcome",),
+            ),
+            *metric_family("telegram_send_waiting", "gauge", "Outgoing calls waiting for a global token.", governor["waiting"]),
+            *metric_family("telegram_retry_after_total", "counter", "429 responses from Telegram.", governor["retry_after"]),
+            *metric_family(
+                "telegram_sends_total", "counter", "Governed outgoing calls by lane.",
+                {(lane,): lane_stats.count for lane, lane_stats in lanes.items()}, ("lane",),
+            ),
+            *metric_family(
+                "telegram_send_wait_seconds_total", "counter", "Total time governed calls waited for tokens, by lane.",
+                {(lane,): lane_stats.total_wait for lane, lane_stats in lanes.items()}, ("lane",),
+            ),
+            *metric_family("invite_links_available", "gauge", "Pre-created invite links in the pool.", invite_pool.available),
+            *metric_family(
+                "invite_links_total", "counter", "Invite links by event.",
+                {("issued",): invite_pool.issued, ("fallback",): invite_pool.fallbacks, ("expired",): invite_pool.expired,
+                 ("revoked",): invite_pool.revoked},
+                ("event",),
+            ),
+            *metric_family(
+                "broadcast_recipients_total", "counter", "Broadcast recipients by broadcast and result.",
+                {
+                    (broadcast_id, result): broadcast[result]
+                    for broadcast_id, broadcast in broadcaster.stats().items()
+                    for result in ("sent", "failed", "blocked", "skipped")
+                },
+                ("broadcast", "result"),
+            ),
+        ]
+
+    metrics.register_collector(collect_updates)
+    metrics.register_collector(collect_backends)
+    metrics.register_collector(collect_delivery)
+
+
+async def timed_step(name: str, step: Awaitable) -> Tuple[str, float, Optional[Exception]]:
+    """
+    Runs a warm-up step with a timeout. Returns its name, duration and error (if any); never raises.
+    """
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(step, timeout=STARTUP_STEP_TIMEOUT)
+        error = None
+    except Exception as e:
+        error = e
+    return name, time.perf_counter() - started, error
+
+
+async def warm_catalog():
+    # Push workflow files changed since the last deploy first; unchanged files are not even read
+    if CATALOG_SYNC_ON_STARTUP:
+        await catalog_sync.sync()
+    workflows = await catalog_cache.get_workflows()
+
+    # Parse every workflow file now, so the first purchase does not; a missing file shows up here
+    # instead of after somebody has paid for it
+    async def warm_template(workflow):
+        try:
+            await blocking_executor.run_io(get_watermark_template, workflow.filepath, workflow.version)
+        except Exception as e:
+            logging.error(f"Workflow '{workflow.slug}' cannot be delivered, its file is unusable: {e}")
+
+    await asyncio.gather(*(warm_template(wf) for wf in workflows))
+    # Watermarking in worker processes uses their own template caches, so they are filled as well
+    await blocking_executor.start_process_pool(
+        warm_watermark_templates, [(workflow.filepath, workflow.version) for workflow in workflows]
+    )
+
+
+async def warm_up(bot: Bot):
+    """
+    Opens the connection pool and preloads everything the first updates need, concurrently.
+    A failed step is logged and the bot starts anyway: every cache can still load on demand.
+    """
+    started = time.perf_counter()
+    await supabase_http_client.start()
+
+    results = await asyncio.gather(
+        timed_step("telegram", bot.get_me()),
+        timed_step("catalog and templates", warm_catalog()),
+        timed_step("price settings", price_service.refresh()),
+        timed_step("ban list", ban_list.load()),
+    )
+    for name, duration, error in results:
+        if error:
+            logging.error(f"Warm-up step '{name}' failed after {duration:.2f}s: {error!r}")
+        else:
+            logging.info(f"Warm-up step '{name}' done in {duration:.2f}s.")
+
+    # Cards depend on both the catalog and the price, so they are rendered last
+    try:
+        workflows = await catalog_cache.get_workflows()
+        card_cache.warm(workflows, await get_current_price(), catalog_cache.version)
+    except Exception as e:
+        logging.error(f"Could not pre-render workflow cards: {e}")
+
+    logging.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s, ready to receive updates.")
+
+
 async def main():
     """
     The main function that initializes and starts the bot.
     """
+    # The cipher is built lazily; build it now so a missing or malformed key stops the bot before it takes payments
+    encryptor.ensure_ready()
+
     # Initialize the bot with the token and default parse mode
     bot = Bot(token=BOT_TOKEN, default_parse_mode=ParseMode.HTML)
+    # Every outgoing message goes through the governor, which keeps the bot within Telegram's limits
+    bot.session.middleware(telegram_governor)
     
-    # Initialize the dispatcher with memory storage for FSM
-    dp = Dispatcher(storage=MemoryStorage())
+    # Initialize the dispatcher with FSM storage from the shared state backend
+    # (in-memory for a single instance, Redis when running several replicas)
+    dp = Dispatcher(storage=shared_state.create_fsm_storage())
 
     # --- Register Middlewares ---
+    # The scheduler wraps every update: per-user ordering, a global concurrency cap and load shedding
+    update_scheduler = UpdateSchedulerMiddleware(
+        max_in_flight=SCHEDULER_MAX_IN_FLIGHT,
+        max_queued_per_user=SCHEDULER_MAX_QUEUED_PER_USER,
+        max_queued=SCHEDULER_MAX_QUEUED,
+    )
+    dp.update.outer_middleware(update_scheduler)
+
     # The order is important. We check for ban first, then for rate limiting.
     dp.message.middleware(BanCheckMiddleware())
     dp.callback_query.middleware(BanCheckMiddleware())
-    dp.message.middleware(RateLimitMiddleware()) # Rate limit only messages
+    # Messages and callback queries have separate per-user budgets but share one global budget
+    global_limiter = TokenBucketLimiter(
+        rate=RATE_LIMIT_GLOBAL_PER_SECOND, capacity=RATE_LIMIT_GLOBAL_BURST,
+        state=shared_state, namespace="ratelimit:global",
+    )
+    dp.message.middleware(RateLimitMiddleware(
+        rate_limit=RATE_LIMIT_MESSAGES, time_period=RATE_LIMIT_MESSAGES_PERIOD,
+        global_limiter=global_limiter, name="messages", state=shared_state,
+    ))
+    dp.callback_query.middleware(RateLimitMiddleware(
+        rate_limit=RATE_LIMIT_CALLBACKS, time_period=RATE_LIMIT_CALLBACKS_PERIOD,
+        global_limiter=global_limiter, name="callbacks", state=shared_state,
+    ))
+    # Registered last, so handler latency does not include the checks above
+    handler_metrics = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    dp.pre_checkout_query.middleware(handler_metrics)
+    register_metric_collectors(update_scheduler)
     
     # --- Register Handlers ---
     # The admin router should come first to catch admin commands
@@ -34,10 +293,57 @@ async def main():
     dp.include_router(catalog_handler.router)
     dp.include_router(payment_handler.router)
     
-    # Start polling
-    # Before starting, we drop all pending updates to avoid processing old messages
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # --- Warm-up ---
+    # Nothing is received before the caches are loaded, so the first users after a deploy are served from memory
+    await warm_up(bot)
+
+    # --- Background Services ---
+    # The ban list is kept fresh by a periodic incremental refresh
+    ban_list.start()
+    # Paid purchases are delivered by background workers; unfinished jobs resume from the local queue
+    fulfillment.start(bot)
+    # Invite links are created ahead of time so delivery never waits on the Telegram API for them
+    invite_pool.start(bot)
+    # Update broadcasts interrupted by the last shutdown continue from their checkpoints
+    await broadcaster.resume_pending(bot)
+    # Non-critical writes are buffered and flushed in bulk; the final flush happens on shutdown
+    write_behind.start()
+    # The endpoint has no authentication, so it is never added to the public webhook app
+    if METRICS_ENABLED and BOT_MODE == "webhook" and METRICS_PORT == WEBHOOK_PORT:
+        logging.error(f"METRICS_PORT is the same as WEBHOOK_PORT ({WEBHOOK_PORT}), the metrics server is not started.")
+    elif METRICS_ENABLED:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            # Metrics are not worth refusing to start over
+            logging.error(f"Could not start the metrics server: {e}")
+
+    # --- Graceful Shutdown ---
+    # Hooks run in this order: let in-flight handlers finish, stop the producers of writes,
+    # flush the buffered writes, and only then close the connections they need
+    async def drain_updates():
+        if not await update_scheduler.wait_idle(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+            logging.warning(
+                f"Shutting down with {update_scheduler.in_flight} updates still in flight "
+                f"and {update_scheduler.queued} queued."
+            )
+
+    dp.shutdown.register(drain_updates)
+    dp.shutdown.register(fulfillment.stop)
+    dp.shutdown.register(broadcaster.stop)
+    dp.shutdown.register(invite_pool.stop)
+    dp.shutdown.register(ban_list.stop)
+    dp.shutdown.register(write_behind.stop)
+    dp.shutdown.register(supabase_http_client.close)
+    dp.shutdown.register(blocking_executor.shutdown)
+    dp.shutdown.register(shared_state.close)
+    dp.shutdown.register(metrics_server.stop)
+
+    # Start receiving updates
+    if BOT_MODE == "webhook":
+        await run_webhook(bot, dp)
+    else:
+        await run_polling(bot, dp)
 
 
 if __name__ == "__main__":
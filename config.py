@@ -5,10 +5,34 @@ load_dotenv()
 
 # Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # "polling" or "webhook"
+
+# Webhook (used when BOT_MODE=webhook)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")  # Public HTTPS URL of the reverse proxy
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT", "false").lower() == "true"  # Several workers on one port
+# With several workers, enable this on exactly one of them
+WEBHOOK_SET_ON_STARTUP = os.getenv("WEBHOOK_SET_ON_STARTUP", "true").lower() == "true"
+# Dropping pending updates also drops unprocessed successful payments, so it is off unless asked for.
+# Applies to polling too, where the webhook is deleted on startup.
+WEBHOOK_DROP_PENDING_UPDATES = os.getenv("WEBHOOK_DROP_PENDING_UPDATES", "false").lower() == "true"
 
 # Supabase
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "200"))
+SUPABASE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SUPABASE_MAX_KEEPALIVE_CONNECTIONS", "50"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))  # Seconds
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))  # Seconds
+SUPABASE_READ_TIMEOUT = float(os.getenv("SUPABASE_READ_TIMEOUT", "10"))  # Seconds
+SUPABASE_WRITE_TIMEOUT = float(os.getenv("SUPABASE_WRITE_TIMEOUT", "10"))  # Seconds
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "false").lower() == "true"
+SUPABASE_RETRY_ATTEMPTS = int(os.getenv("SUPABASE_RETRY_ATTEMPTS", "3"))
+SUPABASE_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("SUPABASE_CIRCUIT_FAILURE_THRESHOLD", "5"))
+SUPABASE_CIRCUIT_RESET_TIMEOUT = float(os.getenv("SUPABASE_CIRCUIT_RESET_TIMEOUT", "30"))  # Seconds
 
 # Payments
 YUKASSA_TOKEN = os.getenv("YUKASSA_TOKEN")
@@ -22,9 +46,92 @@ ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(','))) if os.getenv("
 # Private Channel
 PRIVATE_CHANNEL_ID = os.getenv("PRIVATE_CHANNEL_ID")
 
+# Shared state for running several bot replicas (FSM, rate limits, cache invalidation).
+# Leave REDIS_URL empty to keep everything in-process.
+REDIS_URL = os.getenv("REDIS_URL")
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "shop_bot")
+
+# Caching
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "300"))  # Seconds
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "8"))  # Workflows per catalog page
+CATALOG_KEYBOARD_CACHE_SIZE = int(os.getenv("CATALOG_KEYBOARD_CACHE_SIZE", "1024"))
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "1024"))  # Pre-rendered workflow cards
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "30"))  # Seconds
+BAN_LIST_REFRESH_INTERVAL = int(os.getenv("BAN_LIST_REFRESH_INTERVAL", "60"))  # Seconds
+BAN_LIST_FULL_RELOAD_INTERVAL = int(os.getenv("BAN_LIST_FULL_RELOAD_INTERVAL", "3600"))  # Seconds
+KNOWN_USERS_CACHE_SIZE = int(os.getenv("KNOWN_USERS_CACHE_SIZE", "100000"))
+PROCESSED_PAYMENTS_CACHE_SIZE = int(os.getenv("PROCESSED_PAYMENTS_CACHE_SIZE", "10000"))
+WATERMARK_TEMPLATE_CACHE_SIZE = int(os.getenv("WATERMARK_TEMPLATE_CACHE_SIZE", "256"))
+KEEP_WATERMARKED_FILES = os.getenv("KEEP_WATERMARKED_FILES", "false").lower() == "true"  # Save a copy to WATERMARKED_DIR for audit
+
+# Update scheduling (global concurrency cap, per-user ordering, load shedding)
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "100"))
+SCHEDULER_MAX_QUEUED_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUED_PER_USER", "5"))
+SCHEDULER_MAX_QUEUED = int(os.getenv("SCHEDULER_MAX_QUEUED", "1000"))
+
+# Rate limiting (requests per period, per user; the global budget protects Supabase)
+RATE_LIMIT_MESSAGES = float(os.getenv("RATE_LIMIT_MESSAGES", "5"))
+RATE_LIMIT_MESSAGES_PERIOD = int(os.getenv("RATE_LIMIT_MESSAGES_PERIOD", "5"))  # Seconds
+RATE_LIMIT_CALLBACKS = float(os.getenv("RATE_LIMIT_CALLBACKS", "10"))
+RATE_LIMIT_CALLBACKS_PERIOD = int(os.getenv("RATE_LIMIT_CALLBACKS_PERIOD", "5"))  # Seconds
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "200"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "400"))
+
+# Outbound Telegram API limits (messages per second)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))  # Retries after a 429
+
+# Write-behind queue for non-critical writes
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "2"))  # Seconds
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "50000"))
+
+# Executor for blocking work (file I/O, watermarking, encryption)
+EXECUTOR_MAX_THREADS = int(os.getenv("EXECUTOR_MAX_THREADS", "8"))
+EXECUTOR_MAX_CONCURRENCY = int(os.getenv("EXECUTOR_MAX_CONCURRENCY", "16"))
+EXECUTOR_PROCESS_POOL = os.getenv("EXECUTOR_PROCESS_POOL", "false").lower() == "true"  # Watermark in worker processes
+EXECUTOR_MAX_PROCESSES = int(os.getenv("EXECUTOR_MAX_PROCESSES", "2"))
+
+# Purchase fulfillment (durable job queue and workers)
+FULFILLMENT_QUEUE_PATH = os.getenv("FULFILLMENT_QUEUE_PATH") or os.path.join(os.getcwd(), 'data', 'fulfillment.sqlite3')
+FULFILLMENT_WORKERS = int(os.getenv("FULFILLMENT_WORKERS", "4"))
+FULFILLMENT_STEP_ATTEMPTS = int(os.getenv("FULFILLMENT_STEP_ATTEMPTS", "3"))  # Retries of a step within one run
+FULFILLMENT_MAX_ATTEMPTS = int(os.getenv("FULFILLMENT_MAX_ATTEMPTS", "5"))  # Runs of a job before it is given up
+FULFILLMENT_RETRY_DELAY = float(os.getenv("FULFILLMENT_RETRY_DELAY", "30"))  # Seconds, doubled on every run
+FULFILLMENT_DRAIN_TIMEOUT = float(os.getenv("FULFILLMENT_DRAIN_TIMEOUT", "20"))  # Seconds to let running jobs finish on shutdown
+
+# Update broadcasts to buyers
+BROADCAST_CHECKPOINT_DIR = os.getenv("BROADCAST_CHECKPOINT_DIR") or os.path.join(os.getcwd(), 'data', 'broadcasts')
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))  # Recipients being sent to at once
+
+# Pool of pre-created single-use invite links to PRIVATE_CHANNEL_ID
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "50"))
+INVITE_POOL_LOW_WATER = int(os.getenv("INVITE_POOL_LOW_WATER", "20"))
+INVITE_LINK_TTL_HOURS = float(os.getenv("INVITE_LINK_TTL_HOURS", "48"))
+INVITE_LINK_MIN_VALIDITY_HOURS = float(os.getenv("INVITE_LINK_MIN_VALIDITY_HOURS", "24"))  # Left when handed out
+INVITE_POOL_CREATE_INTERVAL = float(os.getenv("INVITE_POOL_CREATE_INTERVAL", "1"))  # Seconds between creations
+
+# Startup and shutdown
+STARTUP_STEP_TIMEOUT = float(os.getenv("STARTUP_STEP_TIMEOUT", "30"))  # Seconds per warm-up step
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))  # Seconds to let in-flight updates finish
+
+# Metrics endpoint in the Prometheus text format, on a server of its own.
+# It has no authentication: keep METRICS_HOST private and METRICS_PORT different from WEBHOOK_PORT.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
 # Other settings (can be expanded later)
 WORKFLOWS_DIR = os.path.join(os.getcwd(), 'workflows')
 WATERMARKED_DIR = os.path.join(os.getcwd(), 'watermarked')
 LOGS_DIR = os.path.join(os.getcwd(), 'logs')
 BACKUPS_DIR = os.path.join(os.getcwd(), 'backups')
 SCRIPTS_DIR = os.path.join(os.getcwd(), 'scripts')
+
+# Catalog sync from WORKFLOWS_DIR (also available as `python -m utils.catalog_sync`)
+CATALOG_SYNC_ON_STARTUP = os.getenv("CATALOG_SYNC_ON_STARTUP", "false").lower() == "true"
+CATALOG_SYNC_INDEX_PATH = os.getenv("CATALOG_SYNC_INDEX_PATH") or os.path.join(os.getcwd(), 'data', 'catalog_index.json')
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from typing import Optional, Set
+
+from config import BAN_LIST_REFRESH_INTERVAL, BAN_LIST_FULL_RELOAD_INTERVAL
+from database.supabase_http_client import supabase_http_client
+from database.shared_state import GenerationWatcher, shared_state
+from utils.metrics import metrics
+
+# PostgREST caps the number of rows per response, so the full load is paged
+PAGE_SIZE = 1000
+
+BANS = metrics.counter("bot_bans_total", "Users banned through the bot.")
+
+
+class BanList:
+    """
+    An in-memory copy of the banned_users table.
+    The full set is loaded at startup, new bans are picked up incrementally by banned_at,
+    and the whole set is periodically reloaded so that unbans made directly in the database are applied too.
+    """
+
+    def __init__(self, refresh_interval: float, full_reload_interval: float):
+        self._refresh_interval = refresh_interval
+        self._full_reload_interval = full_reload_interval
+        self._banned: Set[int] = set()
+        self._last_banned_at: Optional[str] = None
+        self._loaded_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # Notices bans made through other bot replicas
+        self._watcher = GenerationWatcher(shared_state, "ban_list")
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    @property
+    def size(self) -> int:
+        return len(self._banned)
+
+    async def load(self) -> None:
+        """
+        Loads the complete list of banned users, page by page.
+        """
+        banned: Set[int] = set()
+        last_banned_at = None
+        last_id = None
+        while True:
+            params = {"select": "telegram_id,banned_at", "order": "telegram_id.asc", "limit": PAGE_SIZE}
+            if last_id is not None:
+                params["telegram_id"] = f"gt.{last_id}"
+            rows = await supabase_http_client.select("banned_users", params=params, raise_errors=True)
+            for row in rows:
+                banned.add(int(row["telegram_id"]))
+                if row.get("banned_at") and (last_banned_at is None or row["banned_at"] > last_banned_at):
+                    last_banned_at = row["banned_at"]
+            if len(rows) < PAGE_SIZE:
+                break
+            last_id = rows[-1]["telegram_id"]
+
+        self._banned = banned
+        self._last_banned_at = last_banned_at
+        self._loaded_at = time.monotonic()
+        logging.info(f"Ban list loaded with {len(banned)} banned users.")
+
+    async def refresh_incremental(self) -> None:
+        """
+        Fetches only the bans added since the newest one we already know about.
+        """
+        params = {"select": "telegram_id,banned_at", "order": "banned_at.asc"}
+        if self._last_banned_at:
+            params["banned_at"] = f"gt.{self._last_banned_at}"
+        rows = await supabase_http_client.select("banned_users", params=params, raise_errors=True)
+        for row in rows:
+            self._banned.add(int(row["telegram_id"]))
+            if row.get("banned_at"):
+                self._last_banned_at = row["banned_at"]
+        if rows:
+            logging.info(f"Ban list picked up {len(rows)} new bans.")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                if not self.is_loaded or time.monotonic() - self._loaded_at >= self._full_reload_interval:
+                    await self.load()
+                else:
+                    await self.refresh_incremental()
+            except Exception as e:
+                logging.error(f"Failed to refresh the ban list: {e}")
+
+    def start(self) -> None:
+        """
+        Starts the periodic background refresh.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic background refresh.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def add(self, telegram_id: int) -> None:
+        """
+        Marks a user as banned locally, right after the ban was written to the database,
+        and tells other bot replicas to pick it up.
+        """
+        self._banned.add(telegram_id)
+        BANS.inc()
+        await self._watcher.bump()
+
+    async def is_banned(self, telegram_id: int) -> bool:
+        """
+        Checks whether a user is banned.
+        Falls back to a direct database lookup while the list has not been loaded yet.
+        """
+        if self.is_loaded:
+            if await self._watcher.changed():
+                try:
+                    await self.refresh_incremental()
+                except Exception as e:
+                    logging.error(f"Failed to pick up new bans from another replica: {e}")
+            return telegram_id in self._banned
+
+        banned_user = await supabase_http_client.select(
+            "banned_users",
+            params={"telegram_id": f"eq.{telegram_id}", "select": "telegram_id", "limit": 1}
+        )
+        return bool(banned_user)
+
+
+# Initialize the ban list instance for global use
+ban_list = BanList(
+    refresh_interval=BAN_LIST_REFRESH_INTERVAL,
+    full_reload_interval=BAN_LIST_FULL_RELOAD_INTERVAL,
+)
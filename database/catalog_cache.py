@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from config import CATALOG_CACHE_TTL
+from database.models import Workflow
+from database.resilience import SupabaseError
+from database.shared_state import GenerationWatcher, shared_state
+from database.supabase_http_client import supabase_http_client
+from utils.metrics import cache_requests
+
+# How long stale data is served before the next refresh attempt when Supabase is failing
+STALE_RETRY_INTERVAL = 5.0
+
+
+@dataclass
+class CatalogPage:
+    """
+    One page of a catalog view.
+    version is the catalog version the page was cut from, or None when it came straight from the database.
+    """
+    workflows: List[Workflow]
+    has_prev: bool
+    has_next: bool
+    version: Optional[int] = None
+
+
+def _quote(value: str) -> str:
+    # Double-quotes a value for a PostgREST logical filter, where commas and parentheses are syntax
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class CatalogCache:
+    """
+    An in-process cache of all active workflows.
+    The whole catalog is loaded with a single request and indexed by slug and by priority,
+    so catalog views and deep links are served from memory until the TTL expires
+    or the cache is explicitly invalidated. While Supabase is failing, the last loaded catalog is served.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._workflows: List[Workflow] = []
+        self._by_slug: Dict[str, Workflow] = {}
+        self._by_priority: Dict[int, List[Workflow]] = {}
+        # Position of every workflow in each view (None = all workflows), for keyset paging
+        self._positions: Dict[Optional[int], Dict[int, int]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        # Notices invalidations made by other bot replicas
+        self._watcher = GenerationWatcher(shared_state, "catalog")
+        # Bumped on every reload, so anything derived from the catalog can be keyed on it
+        self.version = 0
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self._ttl
+
+    async def refresh(self) -> None:
+        """
+        Loads all active workflows from the database and rebuilds the indexes.
+        """
+        params = {"is_active": "eq.true", "order": "priority.asc,name.asc,id.asc"}
+        response = await supabase_http_client.select(table="workflows", params=params, raise_errors=True)
+        workflows = [Workflow(**wf) for wf in response]
+
+        by_priority: Dict[int, List[Workflow]] = {}
+        for wf in workflows:
+            by_priority.setdefault(wf.priority, []).append(wf)
+
+        self._workflows = workflows
+        self._by_slug = {wf.slug: wf for wf in workflows}
+        self._by_priority = by_priority
+        self._positions = {None: {wf.id: i for i, wf in enumerate(workflows)}}
+        for priority, items in by_priority.items():
+            self._positions[priority] = {wf.id: i for i, wf in enumerate(items)}
+        self._loaded_at = time.monotonic()
+        self.version += 1
+        logging.info(f"Catalog cache loaded with {len(workflows)} active workflows.")
+
+    async def _ensure_fresh(self) -> None:
+        if await self._watcher.changed():
+            self.invalidate()
+        if self._is_fresh():
+            cache_requests.inc("catalog", "hit")
+            return
+        cache_requests.inc("catalog", "miss")
+        async with self._lock:
+            # Another coroutine may have refreshed the cache while we were waiting
+            if not self._is_fresh():
+                try:
+                    await self.refresh()
+                except SupabaseError as e:
+                    if self._loaded_at is None and not self._workflows:
+                        raise
+                    # Serve the stale catalog and try again shortly instead of on every access
+                    logging.warning(f"Could not refresh the catalog cache, serving stale data. Error: {e}")
+                    self._loaded_at = time.monotonic() - self._ttl + STALE_RETRY_INTERVAL
+
+    def invalidate(self) -> None:
+        """
+        Marks the cache as stale so the next access reloads the catalog.
+        """
+        self._loaded_at = None
+        self.version += 1
+        logging.info("Catalog cache invalidated.")
+
+    async def invalidate_everywhere(self) -> None:
+        """
+        Invalidates the cache in this process and in every other bot replica.
+        """
+        self.invalidate()
+        await self._watcher.bump()
+
+    async def get_workflows(self, priority: Optional[int] = None) -> List[Workflow]:
+        """
+        Returns active workflows ordered by priority and name, optionally filtered by priority.
+        """
+        await self._ensure_fresh()
+        if priority:
+            return list(self._by_priority.get(priority, []))
+        return list(self._workflows)
+
+    async def get_by_slug(self, slug: str) -> Optional[Workflow]:
+        """
+        Returns an active workflow by its slug, or None if it is not in the catalog.
+        """
+        await self._ensure_fresh()
+        return self._by_slug.get(slug)
+
+    async def get_page(
+        self,
+        priority: Optional[int] = None,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+        limit: int = 8,
+    ) -> CatalogPage:
+        """
+        Returns the page of a catalog view (ordered by priority, name) that follows after_id or precedes before_id.
+        Pages are keyed on a workflow id rather than an offset, so they do not shift when the catalog changes.
+        """
+        try:
+            await self._ensure_fresh()
+        except SupabaseError as e:
+            logging.warning(f"Catalog cache unavailable, paging from the database: {e}")
+            return await self._fetch_page(priority, after_id, before_id, limit)
+
+        key = priority or None
+        items = self._by_priority.get(priority, []) if key else self._workflows
+        positions = self._positions.get(key, {})
+        if before_id is not None and before_id in positions:
+            end = positions[before_id]
+            start = max(0, end - limit)
+        else:
+            # An unknown anchor (e.g. a workflow deactivated meanwhile) restarts the view
+            start = positions[after_id] + 1 if after_id in positions else 0
+            end = start + limit
+        return CatalogPage(
+            workflows=items[start:end],
+            has_prev=start > 0,
+            has_next=end < len(items),
+            version=self.version,
+        )
+
+    async def _fetch_page(
+        self, priority: Optional[int], after_id: Optional[int], before_id: Optional[int], limit: int
+    ) -> CatalogPage:
+        """
+        Keyset-paginated query on (priority, name, id), used while the catalog cannot be loaded as a whole.
+        """
+        backwards = before_id is not None
+        anchor_id = before_id if backwards else after_id
+        params = {"is_active": "eq.true", "select": "*", "limit": limit + 1}
+        if priority:
+            params["priority"] = f"eq.{priority}"
+
+        anchor = None
+        if anchor_id:
+            rows = await supabase_http_client.select(
+                "workflows", params={"id": f"eq.{anchor_id}", "select": "id,priority,name"}, raise_errors=True
+            )
+            anchor = rows[0] if rows else None
+        if anchor:
+            op = "lt" if backwards else "gt"
+            p, name, wf_id = anchor["priority"], _quote(anchor["name"]), anchor["id"]
+            params["or"] = (
+                f"(priority.{op}.{p},and(priority.eq.{p},name.{op}.{name}),"
+                f"and(priority.eq.{p},name.eq.{name},id.{op}.{wf_id}))"
+            )
+        direction = "desc" if backwards and anchor else "asc"
+        params["order"] = f"priority.{direction},name.{direction},id.{direction}"
+
+        rows = await supabase_http_client.select("workflows", params=params, raise_errors=True)
+        more = len(rows) > limit
+        workflows = [Workflow(**row) for row in rows[:limit]]
+        if backwards and anchor:
+            workflows.reverse()
+            return CatalogPage(workflows=workflows, has_prev=more, has_next=True)
+        return CatalogPage(workflows=workflows, has_prev=anchor is not None, has_next=more)
+
+
+# Initialize the catalog cache instance for global use
+catalog_cache = CatalogCache(ttl=CATALOG_CACHE_TTL)
+
+
+async def get_workflows_from_db(priority: int = None) -> list[Workflow]:
+    """
+    Fetches a list of active workflows, served from the in-process catalog cache.
+    """
+    try:
+        return await catalog_cache.get_workflows(priority)
+    except Exception as e:
+        logging.error(f"Error fetching workflows from DB: {e}", exc_info=True)
+        return []
+
+
+async def get_workflow_by_slug(slug: str, raise_errors: bool = False) -> Workflow | None:
+    """
+    Fetches a single workflow by its unique slug.
+    Active workflows are served from the catalog cache; anything else falls back to the database
+    so that purchases of a just-deactivated workflow can still be fulfilled.
+    Returns None on failure unless raise_errors is set, which tells a missing workflow from an outage.
+    """
+    try:
+        workflow = await catalog_cache.get_by_slug(slug)
+        if workflow:
+            return workflow
+
+        params = {"slug": f"eq.{slug}", "select": "*", "limit": 1}
+        response = await supabase_http_client.select(table="workflows", params=params, raise_errors=raise_errors)
+        if response:
+            return Workflow(**response[0])
+        return None
+    except Exception as e:
+        if raise_errors:
+            raise
+        logging.error(f"Error fetching workflow by slug '{slug}': {e}", exc_info=True)
+        return None
@@ -0,0 +1,100 @@
+import hashlib
+import logging
+from typing import Any, Dict, Optional, Set
+
+from cachetools import LRUCache
+
+from config import PROCESSED_PAYMENTS_CACHE_SIZE
+from database.supabase_http_client import supabase_http_client
+
+
+def hash_charge_id(charge_id: str) -> str:
+    """
+    Returns a deterministic key for a Telegram payment charge id.
+    payment_id is stored Fernet-encrypted, which is non-deterministic, so duplicates are
+    detected through this hash (purchases.payment_hash, unique in the database).
+    """
+    return hashlib.sha256(charge_id.encode()).hexdigest()
+
+
+class PaymentDeduplicator:
+    """
+    Makes successful payment processing idempotent.
+    A payment is claimed before any work is done: recently processed or in-progress charges are
+    rejected from memory, anything else is checked against purchases.payment_hash in the database,
+    so redelivered updates short-circuit before any DB write or watermarking.
+    The claim is only a fast path: two replicas can both claim a charge before either saved it.
+    record_purchase() settles that race on the unique key of purchases.payment_hash.
+    """
+
+    def __init__(self, cache_size: int):
+        self._processed = LRUCache(maxsize=cache_size)
+        self._in_progress: Set[str] = set()
+
+    async def claim(self, charge_id: str) -> Optional[str]:
+        """
+        Claims a payment for processing.
+        Returns its hash if the caller should process it, or None if it is a duplicate.
+        """
+        payment_hash = hash_charge_id(charge_id)
+        if payment_hash in self._processed or payment_hash in self._in_progress:
+            return None
+        # Claimed before the first await, so concurrent duplicates in this process are rejected too
+        self._in_progress.add(payment_hash)
+
+        try:
+            existing = await supabase_http_client.select(
+                "purchases",
+                params={"payment_hash": f"eq.{payment_hash}", "select": "id", "limit": 1},
+                raise_errors=True,
+            )
+        except Exception as e:
+            # The unique key on payment_hash still protects the insert, so process rather than drop a paid order
+            logging.error(f"Could not check payment {payment_hash[:12]} for duplicates, processing it: {e}")
+            existing = []
+
+        if existing:
+            self._in_progress.discard(payment_hash)
+            self._processed[payment_hash] = True
+            return None
+        return payment_hash
+
+    def complete(self, payment_hash: str) -> None:
+        """
+        Marks a claimed payment as processed.
+        """
+        self._in_progress.discard(payment_hash)
+        self._processed[payment_hash] = True
+
+    async def record_purchase(self, purchase: Dict[str, Any]) -> bool:
+        """
+        Saves a purchase unless one with the same payment_hash exists.
+        Returns True if the purchase is ours: this call inserted it, or an earlier attempt of the same
+        fulfillment did (the encrypted payment_id is unique per attempt, since Fernet is non-deterministic).
+        Returns False if somebody else (e.g. another replica) recorded the charge, i.e. it is a duplicate.
+        Raises SupabaseError if the write fails, so a failure is never taken for a saved purchase.
+        """
+        payment_hash = purchase["payment_hash"]
+        inserted = await supabase_http_client.insert_ignore(
+            "purchases", purchase, on_conflict="payment_hash", raise_errors=True
+        )
+        self._processed[payment_hash] = True
+        if inserted:
+            return True
+        # A retry after a lost response finds its own row; a duplicate finds another one
+        existing = await supabase_http_client.select(
+            "purchases",
+            params={"payment_hash": f"eq.{payment_hash}", "select": "payment_id", "limit": 1},
+            raise_errors=True,
+        )
+        return bool(existing) and existing[0].get("payment_id") == purchase["payment_id"]
+
+    def release(self, payment_hash: str) -> None:
+        """
+        Gives a claimed payment back, e.g. when it could not be saved, so a redelivery can retry it.
+        """
+        self._in_progress.discard(payment_hash)
+
+
+# Initialize the deduplicator instance for global use
+payment_deduplicator = PaymentDeduplicator(cache_size=PROCESSED_PAYMENTS_CACHE_SIZE)
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from utils.executor import blocking_executor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    completed_steps TEXT NOT NULL DEFAULT '[]',
+    started_steps TEXT NOT NULL DEFAULT '[]',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, available_at);
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    key: str
+    kind: str
+    payload: Dict[str, Any]
+    completed_steps: List[str] = field(default_factory=list)
+    attempts: int = 0
+    # Steps that were begun and neither finished nor known to have failed
+    started_steps: List[str] = field(default_factory=list)
+
+
+class JobQueue:
+    """
+    A durable job queue backed by a local SQLite file.
+    Jobs survive restarts: anything left 'running' by a crash is put back to 'pending' on open.
+    Each job keeps the list of steps it has completed, so a retry resumes where it failed.
+    The sqlite calls are blocking, so the async methods run them on the blocking executor.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            # Queue files created before started_steps existed
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "started_steps" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN started_steps TEXT NOT NULL DEFAULT '[]'")
+            recovered = conn.execute(
+                "UPDATE jobs SET state = 'pending' WHERE state = 'running'"
+            ).rowcount
+            if recovered:
+                logging.warning(f"Job queue recovered {recovered} jobs interrupted by a restart.")
+            self._conn = conn
+        return self._conn
+
+    # --- Blocking implementations ---
+
+    def _enqueue(self, kind: str, key: str, payload: Dict[str, Any]) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT OR IGNORE INTO jobs (job_key, kind, payload, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, json.dumps(payload), now, now, now),
+            )
+            return cursor.rowcount == 1
+
+    def _claim_next(self, kind: str) -> Optional[Job]:
+        now = time.time()
+        with self._lock:
+            row = self._connect().execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, updated_at = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE state = 'pending' AND kind = ? AND available_at <= ? "
+                "ORDER BY available_at LIMIT 1) "
+                "RETURNING id, job_key, kind, payload, completed_steps, attempts, started_steps",
+                (now, kind, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(
+            id=row[0], key=row[1], kind=row[2], payload=json.loads(row[3]),
+            completed_steps=json.loads(row[4]), attempts=row[5], started_steps=json.loads(row[6]),
+        )
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._connect().execute(sql, params)
+
+    def _depth(self, kind: str) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND state IN ('pending', 'running')", (kind,)
+            ).fetchone()[0]
+
+    # --- Async API ---
+
+    async def enqueue(self, kind: str, key: str, payload: Dict[str, Any]) -> bool:
+        """
+        Adds a job. Returns False if a job with the same key already exists.
+        """
+        return await blocking_executor.run_io(self._enqueue, kind, key, payload)
+
+    async def claim_next(self, kind: str) -> Optional[Job]:
+        """
+        Takes the oldest ready job of a kind and marks it running.
+        """
+        return await blocking_executor.run_io(self._claim_next, kind)
+
+    async def mark_step_done(self, job: Job, step: str) -> None:
+        job.completed_steps.append(step)
+        await blocking_executor.run_io(
+            self._execute,
+            "UPDATE jobs SET completed_steps = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job.completed_steps), time.time(), job.id),
+        )
+
+    async def save_payload(self, job: Job) -> None:
+        """
+        Persists changes a step made to the job's payload, so later runs see them.
+        """
+        await blocking_executor.run_io(
+            self._execute,
+            "UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job.payload), time.time(), job.id),
+        )
+
+    async def _save_started_steps(self, job: Job) -> None:
+        await blocking_executor.run_io(
+            self._execute,
+            "UPDATE jobs SET started_steps = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job.started_steps), time.time(), job.id),
+        )
+
+    async def mark_step_started(self, job: Job, step: str) -> None:
+        """
+        Records that a step is about to run, so a later run knows it may already have taken effect.
+        """
+        if step not in job.started_steps:
+            job.started_steps.append(step)
+            await self._save_started_steps(job)
+
+    async def clear_step_started(self, job: Job, step: str) -> None:
+        """
+        Forgets a started step that is known not to have taken effect.
+        """
+        if step in job.started_steps:
+            job.started_steps.remove(step)
+            await self._save_started_steps(job)
+
+    async def retry_later(self, job: Job, error: str, delay: float) -> None:
+        now = time.time()
+        await blocking_executor.run_io(
+            self._execute,
+            "UPDATE jobs SET state = 'pending', last_error = ?, available_at = ?, updated_at = ? WHERE id = ?",
+            (error, now + delay, now, job.id),
+        )
+
+    async def complete(self, job: Job) -> None:
+        await blocking_executor.run_io(
+            self._execute, "UPDATE jobs SET state = 'done', updated_at = ? WHERE id = ?", (time.time(), job.id),
+        )
+
+    async def fail(self, job: Job, error: str) -> None:
+        await blocking_executor.run_io(
+            self._execute,
+            "UPDATE jobs SET state = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+            (error, time.time(), job.id),
+        )
+
+    async def depth(self, kind: str) -> int:
+        """
+        Returns the number of pending and running jobs of a kind.
+        """
+        return await blocking_executor.run_io(self._depth, kind)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -44,6 +44,7 @@ class Purchase:
     download_count: int = 0
     last_download_at: Optional[datetime] = None
     ip_address: Optional[str] = None
+    payment_hash: Optional[str] = None # SHA-256 of the charge id, unique; payment_id itself is encrypted
 
 @dataclass
 class WorkflowUpdate:
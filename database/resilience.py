@@ -0,0 +1,122 @@
+import logging
+import random
+import time
+
+import httpx
+
+# Statuses that indicate a transient problem on the Supabase side
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Errors raised before the request reached the server, safe to retry even for non-idempotent writes
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class SupabaseError(Exception):
+    """
+    Raised by SupabaseHttpClient when a request fails and the caller asked for errors to be raised.
+    """
+
+
+class CircuitOpenError(SupabaseError):
+    """
+    Raised when a request is rejected without being sent because the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    A consecutive-failure circuit breaker.
+    After failure_threshold failures in a row the circuit opens and requests fail fast for reset_timeout seconds.
+    Then a single trial request is let through (half-open): success closes the circuit, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = self.CLOSED
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow_request(self) -> bool:
+        """
+        Returns True if a request may be sent. In the half-open state only one trial request is let through;
+        its caller must end it with record_success(), record_failure() or release_trial().
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self._state != self.CLOSED:
+            logging.info("Supabase circuit breaker closed.")
+        self._failures = 0
+        self._state = self.CLOSED
+        self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """
+        Frees the half-open trial slot without recording an outcome, e.g. when the trial request was cancelled.
+        """
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+            if self._state != self.OPEN:
+                logging.error(f"Supabase circuit breaker opened after {self._failures} consecutive failures.")
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff ("full jitter"): the n-th retry waits a random time in [0, base * 2**n], capped.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self._max_delay, self._base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def is_retryable(error: Exception, idempotent: bool) -> bool:
+        """
+        Decides whether a failed request may be sent again.
+        Non-idempotent writes are only retried when the request never reached the server.
+        """
+        if isinstance(error, CONNECT_ERRORS):
+            return True
+        if not idempotent:
+            return False
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in RETRYABLE_STATUS_CODES
+        return isinstance(error, httpx.TransportError)
+
+    @staticmethod
+    def is_server_failure(error: Exception) -> bool:
+        """
+        Tells whether an error says something about Supabase health (as opposed to a bad request).
+        """
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500 or error.response.status_code in (408, 429)
+        return isinstance(error, httpx.TransportError)
@@ -0,0 +1,235 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, Optional
+
+from cachetools import TTLCache
+
+from config import REDIS_URL, SHARED_STATE_PREFIX
+
+if TYPE_CHECKING:
+    # aiogram's FSM storage pulls in all of aiogram.types; it is only imported when a storage is created
+    from aiogram.fsm.storage.base import BaseStorage
+
+# Atomic token bucket: refills by elapsed time, takes one token if available.
+# KEYS[1] = bucket key; ARGV = rate (tokens/s), capacity, now (s), ttl (s). Returns 1 if allowed.
+TOKEN_BUCKET_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return allowed
+"""
+
+
+class SharedState(ABC):
+    """
+    State that has to be shared by all bot replicas: rate-limit buckets and cache generations.
+    The local implementation keeps everything in-process; RedisSharedState keeps it in Redis
+    (or anything speaking the Redis protocol) so several replicas behind a load balancer agree.
+    """
+
+    @abstractmethod
+    async def take_token(self, key: str, rate: float, capacity: float) -> bool:
+        """
+        Takes one token from the bucket stored under key. Returns False if the bucket is empty.
+        """
+
+    @abstractmethod
+    async def get_generation(self, key: str) -> int:
+        """
+        Returns the current value of a generation counter (0 if it was never bumped).
+        """
+
+    @abstractmethod
+    async def bump_generation(self, key: str) -> int:
+        """
+        Increments a generation counter, telling every replica that the data behind key changed.
+        Returns the new value.
+        """
+
+    @abstractmethod
+    def create_fsm_storage(self) -> "BaseStorage":
+        """
+        Returns the aiogram FSM storage matching this backend.
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalSharedState(SharedState):
+    """
+    In-process shared state, for a single bot instance.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self._buckets = TTLCache(maxsize=maxsize, ttl=3600)
+        self._generations: dict[str, int] = {}
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> bool:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    async def get_generation(self, key: str) -> int:
+        return self._generations.get(key, 0)
+
+    async def bump_generation(self, key: str) -> int:
+        self._generations[key] = self._generations.get(key, 0) + 1
+        return self._generations[key]
+
+    def create_fsm_storage(self) -> "BaseStorage":
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+
+
+class RedisSharedState(SharedState):
+    """
+    Shared state kept in Redis. Accepts any redis.asyncio-compatible client (e.g. fakeredis in tests).
+    """
+
+    def __init__(self, redis: Any, prefix: str = "shop_bot"):
+        self._redis = redis
+        self._prefix = prefix
+        self._token_bucket = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "shop_bot") -> "RedisSharedState":
+        try:
+            from redis.asyncio import Redis
+        except ImportError as e:
+            raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed.") from e
+        return cls(Redis.from_url(url), prefix=prefix)
+
+    def _key(self, key: str) -> str:
+        return f"{self._prefix}:{key}"
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> bool:
+        # Wall-clock time, since the bucket is shared between hosts
+        ttl = max(1, int(capacity / rate) + 1) if rate > 0 else 3600
+        allowed = await self._token_bucket(keys=[self._key(key)], args=[rate, capacity, time.time(), ttl])
+        return bool(allowed)
+
+    async def get_generation(self, key: str) -> int:
+        value = await self._redis.get(self._key(f"generation:{key}"))
+        return int(value) if value else 0
+
+    async def bump_generation(self, key: str) -> int:
+        return await self._redis.incr(self._key(f"generation:{key}"))
+
+    def create_fsm_storage(self) -> "BaseStorage":
+        from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+        return RedisStorage(redis=self._redis, key_builder=DefaultKeyBuilder(prefix=f"{self._prefix}:fsm"))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+        logging.info("Redis shared state closed.")
+
+
+class GenerationWatcher:
+    """
+    Lets an in-process cache notice invalidations made by other replicas.
+    The shared generation counter is read at most once per check_interval seconds.
+    """
+
+    def __init__(self, state: SharedState, key: str, check_interval: float = 1.0):
+        self._state = state
+        self._key = key
+        self._check_interval = check_interval
+        self._generation: Optional[int] = None
+        self._checked_at = 0.0
+        # Set when our own bump revealed a bump by another replica that changed() has not reported yet
+        self._missed_change = False
+
+    async def changed(self) -> bool:
+        """
+        Returns True once each time the generation moved since the previous check.
+        """
+        if self._missed_change:
+            self._missed_change = False
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < self._check_interval:
+            return False
+        self._checked_at = now
+        try:
+            generation = await self._state.get_generation(self._key)
+        except Exception as e:
+            logging.error(f"Could not read the shared generation of '{self._key}': {e}")
+            return False
+        changed = self._generation is not None and generation != self._generation
+        self._generation = generation
+        return changed
+
+    async def bump(self) -> None:
+        """
+        Announces a change to every replica (this one included, which already knows about it).
+        """
+        try:
+            previous = self._generation
+            self._generation = await self._state.bump_generation(self._key)
+            # Anything but previous + 1 means another replica bumped since our last check;
+            # its change must still be picked up, so the next changed() reports it
+            if previous is not None and self._generation != previous + 1:
+                self._missed_change = True
+        except Exception as e:
+            logging.error(f"Could not bump the shared generation of '{self._key}': {e}")
+
+
+def create_shared_state() -> SharedState:
+    """
+    Builds the shared state backend: Redis when REDIS_URL is set, in-process otherwise.
+    """
+    if REDIS_URL:
+        logging.info("Using Redis for FSM storage, rate limits and cache invalidation.")
+        return RedisSharedState.from_url(REDIS_URL, prefix=SHARED_STATE_PREFIX)
+    return LocalSharedState()
+
+
+class LazySharedState(SharedState):
+    """
+    Builds the real backend on first use, so importing a module that holds a reference to the
+    shared state does not import the Redis client or create one.
+    """
+
+    def __init__(self):
+        self._backend: Optional[SharedState] = None
+
+    def _get(self) -> SharedState:
+        if self._backend is None:
+            self._backend = create_shared_state()
+        return self._backend
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> bool:
+        return await self._get().take_token(key, rate, capacity)
+
+    async def get_generation(self, key: str) -> int:
+        return await self._get().get_generation(key)
+
+    async def bump_generation(self, key: str) -> int:
+        return await self._get().bump_generation(key)
+
+    def create_fsm_storage(self) -> "BaseStorage":
+        return self._get().create_fsm_storage()
+
+    async def close(self) -> None:
+        if self._backend is not None:
+            await self._backend.close()
+
+
+# Initialize the shared state instance for global use (the backend is created on first use)
+shared_state = LazySharedState()
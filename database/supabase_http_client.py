@@ -1,130 +1,373 @@
+import asyncio
 import httpx
 import logging
+import time
+from collections import Counter
 from typing import List, Dict, Any, Optional
 
-from config import SUPABASE_URL, SUPABASE_KEY
+from config import (
+    SUPABASE_URL, SUPABASE_KEY,
+    SUPABASE_MAX_CONNECTIONS, SUPABASE_MAX_KEEPALIVE_CONNECTIONS, SUPABASE_KEEPALIVE_EXPIRY,
+    SUPABASE_CONNECT_TIMEOUT, SUPABASE_READ_TIMEOUT, SUPABASE_WRITE_TIMEOUT, SUPABASE_HTTP2,
+    SUPABASE_RETRY_ATTEMPTS, SUPABASE_CIRCUIT_FAILURE_THRESHOLD, SUPABASE_CIRCUIT_RESET_TIMEOUT,
+)
+from database.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, SupabaseError
+from utils.metrics import metrics
 
 # The schema where all our tables are located
 SCHEMA_NAME = "n8n_workflows_sales"
 
+REQUEST_SECONDS = metrics.histogram(
+    "supabase_request_duration_seconds",
+    "Supabase requests by verb, table and outcome, including retries.",
+    ("verb", "table", "status"),
+)
+
 class SupabaseHttpClient:
     """
     A simple asynchronous HTTP client for interacting with the Supabase PostgREST API.
     This client is tailored for the needs of this specific bot.
+    A single pooled connection is shared by all requests; call start() on startup and close() on shutdown.
+    Transient failures are retried with backoff and a circuit breaker fails fast while Supabase is down.
     """
 
-    def __init__(self, url: str, key: str, schema: str):
-        if not url or not key:
-            raise ValueError("Supabase URL and Key must be set.")
-        
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        schema: str,
+        max_connections: int = 200,
+        max_keepalive_connections: int = 50,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 10.0,
+        write_timeout: float = 10.0,
+        http2: bool = False,
+        retry_attempts: int = 3,
+        circuit_failure_threshold: int = 5,
+        circuit_reset_timeout: float = 30.0,
+    ):
+        # Checked when the connection is opened, so modules importing the client load without credentials
+        self._configured = bool(url and key)
         self._url = f"{url}/rest/v1"
         self._schema = schema
-        # Base headers, schema-specific headers will be added per request
-        self._base_headers = {
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2 and self._http2_available()
+
+        # Per-operation timeouts: reads should fail faster than writes
+        self._read_timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout)
+        self._write_timeout = httpx.Timeout(write_timeout, connect=connect_timeout, pool=connect_timeout)
+
+        # Headers are built once per verb instead of on every call
+        base_headers = {
             "apikey": key,
             "Authorization": f"Bearer {key}",
         }
-        self._client = httpx.AsyncClient()
+        self._select_headers = {**base_headers, "Accept-Profile": schema}  # Correct header for GET
+        self._insert_headers = {
+            **base_headers,
+            "Content-Profile": schema,  # Correct header for POST
+            "Content-Type": "application/json",
+            "Prefer": "return=representation",
+        }
+        self._bulk_insert_headers = {**self._insert_headers, "Prefer": "return=minimal"}
+        self._upsert_headers = {**self._insert_headers, "Prefer": "resolution=merge-duplicates,return=minimal"}
+        self._upsert_ignore_headers = {**self._insert_headers, "Prefer": "resolution=ignore-duplicates,return=minimal"}
+        # PostgREST only echoes the rows it actually inserted, which tells a new row from an existing one
+        self._insert_ignore_headers = {**self._insert_headers, "Prefer": "resolution=ignore-duplicates,return=representation"}
+        self._update_headers = {**base_headers, "Content-Profile": schema, "Content-Type": "application/json"}
+        self._rpc_headers = {**base_headers, "Content-Type": "application/json"}
+
+        self._client: Optional[httpx.AsyncClient] = None
+
+        # Resilience: retries for transient errors, fail-fast while Supabase is down
+        self._retry_policy = RetryPolicy(max_attempts=retry_attempts)
+        self._breaker = CircuitBreaker(
+            failure_threshold=circuit_failure_threshold,
+            reset_timeout=circuit_reset_timeout,
+        )
+        self.error_counts: Counter = Counter()  # Failed requests per table / RPC function
 
-    async def select(self, table: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    @property
+    def circuit_state(self) -> str:
+        return self._breaker.state
+
+    @staticmethod
+    def _http2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logging.warning("HTTP/2 requested for Supabase but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            return False
+
+    async def start(self) -> None:
         """
-        Performs a SELECT operation on a table.
+        Opens the shared connection pool.
         """
-        headers = self._base_headers.copy()
-        headers["Accept-Profile"] = self._schema # Correct header for GET
+        if not self._configured:
+            raise ValueError("Supabase URL and Key must be set.")
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=self._limits,
+                timeout=self._read_timeout,
+                http2=self._http2,
+            )
+            logging.info(f"Supabase HTTP client started (http2={self._http2}).")
+
+    async def close(self) -> None:
+        """
+        Closes the shared connection pool.
+        """
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logging.info("Supabase HTTP client closed.")
+        self._client = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Opened lazily so the client also works outside of the bot lifecycle (scripts, REPL)
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        return self._client
+
+    async def _request(
+        self,
+        operation: str,
+        target: str,
+        method: str,
+        path: str,
+        idempotent: bool,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """
+        Sends a request through the circuit breaker, retrying transient failures with jittered backoff.
+        Raises SupabaseError (or CircuitOpenError) once the request is given up on.
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._send(operation, target, method, path, idempotent, **kwargs)
+            status = "ok"
+            return response
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, operation, target, status)
+
+    async def _send(
+        self,
+        operation: str,
+        target: str,
+        method: str,
+        path: str,
+        idempotent: bool,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        is_trial = self._breaker.state == CircuitBreaker.HALF_OPEN
+        if not self._breaker.allow_request():
+            self.error_counts[target] += 1
+            raise CircuitOpenError(f"Supabase circuit is open, {operation} on '{target}' rejected.")
+
+        try:
+            client = await self._get_client()
+            attempt = 0
+            while True:
+                try:
+                    response = await client.request(method, f"{self._url}/{path}", **kwargs)
+                    response.raise_for_status()
+                    self._breaker.record_success()
+                    return response
+                except Exception as e:
+                    retryable = self._retry_policy.is_retryable(e, idempotent)
+                    if attempt + 1 < self._retry_policy.max_attempts and retryable:
+                        delay = self._retry_policy.backoff(attempt)
+                        logging.warning(f"Transient error during {operation} on '{target}' ({e!r}), retrying in {delay:.2f}s.")
+                        attempt += 1
+                        await asyncio.sleep(delay)
+                        continue
+
+                    self.error_counts[target] += 1
+                    if self._retry_policy.is_server_failure(e):
+                        self._breaker.record_failure()
+                    else:
+                        self._breaker.record_success()
 
+                    if isinstance(e, httpx.HTTPStatusError):
+                        raise SupabaseError(
+                            f"HTTP error during {operation} on '{target}': {e.response.status_code} - {e.response.text}"
+                        ) from e
+                    raise SupabaseError(f"Unexpected error during {operation} on '{target}': {e!r}") from e
+        finally:
+            if is_trial:
+                # A trial cancelled mid-flight (a wait_for timeout, shutdown) recorded no outcome;
+                # without this the slot stays taken and every later request is rejected
+                self._breaker.release_trial()
+
+    async def select(
+        self,
+        table: str,
+        params: Optional[Dict[str, Any]] = None,
+        raise_errors: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Performs a SELECT operation on a table.
+        Returns [] on failure unless raise_errors is set, which lets caches keep serving stale data.
+        """
         try:
-            response = await self._client.get(
-                f"{self._url}/{table}", 
-                params=params, 
-                headers=headers
+            response = await self._request(
+                "SELECT", table, "GET", table, idempotent=True,
+                params=params, headers=self._select_headers, timeout=self._read_timeout,
             )
-            response.raise_for_status()
             return response.json()
-        except httpx.HTTPStatusError as e:
-            logging.error(f"HTTP error during SELECT on '{table}': {e.response.status_code} - {e.response.text}")
-            return []
-        except Exception as e:
-            logging.error(f"Unexpected error during SELECT on '{table}': {e}", exc_info=True)
+        except SupabaseError as e:
+            if raise_errors:
+                raise
+            logging.error(str(e))
             return []
 
     async def insert(self, table: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
         Performs an INSERT operation on a table.
         """
-        headers = self._base_headers.copy()
-        headers["Content-Profile"] = self._schema # Correct header for POST
-        headers["Content-Type"] = "application/json"
-        headers["Prefer"] = "return=representation"
-
         try:
-            response = await self._client.post(
-                f"{self._url}/{table}", 
-                json=data, 
-                headers=headers
+            response = await self._request(
+                "INSERT", table, "POST", table, idempotent=False,
+                json=data, headers=self._insert_headers, timeout=self._write_timeout,
             )
-            response.raise_for_status()
-            
             result = response.json()
             return result[0] if result else None
-        except httpx.HTTPStatusError as e:
-            logging.error(f"HTTP error during INSERT on '{table}': {e.response.status_code} - {e.response.text}")
+        except SupabaseError as e:
+            logging.error(str(e))
             return None
-        except Exception as e:
-            logging.error(f"Unexpected error during INSERT on '{table}': {e}", exc_info=True)
+
+    async def bulk_insert(self, table: str, rows: List[Dict[str, Any]], raise_errors: bool = False) -> bool:
+        """
+        Inserts several rows with a single request. All rows must have the same keys.
+        Returns True on success; the rows are not echoed back (return=minimal).
+        Returns False on failure unless raise_errors is set.
+        """
+        if not rows:
+            return True
+        try:
+            await self._request(
+                "BULK INSERT", table, "POST", table, idempotent=False,
+                json=rows, headers=self._bulk_insert_headers, timeout=self._write_timeout,
+            )
+            return True
+        except SupabaseError as e:
+            if raise_errors:
+                raise
+            logging.error(str(e))
+            return False
+
+    async def upsert(
+        self,
+        table: str,
+        data: Dict[str, Any] | List[Dict[str, Any]],
+        on_conflict: str,
+        ignore_duplicates: bool = False,
+        raise_errors: bool = False,
+    ) -> bool:
+        """
+        Inserts one or several rows, resolving conflicts on the on_conflict column(s) in the same request.
+        Existing rows are updated (merge-duplicates) or left untouched when ignore_duplicates is set.
+        Returns True on success, False on failure unless raise_errors is set.
+        """
+        if not data:
+            return True
+        headers = self._upsert_ignore_headers if ignore_duplicates else self._upsert_headers
+        try:
+            # Upserts converge to the same state when repeated, so they are safe to retry
+            await self._request(
+                "UPSERT", table, "POST", table, idempotent=True,
+                params={"on_conflict": on_conflict}, json=data, headers=headers, timeout=self._write_timeout,
+            )
+            return True
+        except SupabaseError as e:
+            if raise_errors:
+                raise
+            logging.error(str(e))
+            return False
+
+    async def insert_ignore(
+        self,
+        table: str,
+        data: Dict[str, Any] | List[Dict[str, Any]],
+        on_conflict: str,
+        raise_errors: bool = False,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Inserts rows unless a row with the same on_conflict value(s) exists.
+        Returns the rows that were inserted ([] if all of them already existed),
+        or None on failure unless raise_errors is set.
+        """
+        try:
+            # Repeating it cannot create a second row, so it is safe to retry
+            response = await self._request(
+                "INSERT IGNORE", table, "POST", table, idempotent=True,
+                params={"on_conflict": on_conflict}, json=data, headers=self._insert_ignore_headers,
+                timeout=self._write_timeout,
+            )
+            return response.json()
+        except SupabaseError as e:
+            if raise_errors:
+                raise
+            logging.error(str(e))
             return None
 
-    async def rpc(self, function_name: str, params: Optional[Dict[str, Any]] = None) -> Any:
+    async def rpc(self, function_name: str, params: Optional[Dict[str, Any]] = None, raise_errors: bool = False) -> Any:
         """
         Calls a PostgreSQL function (RPC).
+        Returns None on failure unless raise_errors is set.
         """
-        headers = self._base_headers.copy()
-        headers["Content-Type"] = "application/json"
-        
         try:
-            response = await self._client.post(
-                f"{self._url}/rpc/{function_name}",
-                json=params,
-                headers=headers
+            response = await self._request(
+                "RPC", function_name, "POST", f"rpc/{function_name}", idempotent=False,
+                json=params, headers=self._rpc_headers, timeout=self._write_timeout,
             )
-            response.raise_for_status()
             if response.status_code == 204 or not response.content:
                 return None
             return response.json()
-        except httpx.HTTPStatusError as e:
-            logging.error(f"HTTP error during RPC call to '{function_name}': {e.response.status_code} - {e.response.text}")
-            return None
-        except Exception as e:
-            logging.error(f"Unexpected error during RPC call to '{function_name}': {e}", exc_info=True)
+        except SupabaseError as e:
+            if raise_errors:
+                raise
+            logging.error(str(e))
             return None
 
     async def update(self, table: str, match: Dict[str, Any], new_data: Dict[str, Any]) -> Any:
         """
         Performs an UPDATE operation on a table.
         """
-        headers = self._base_headers.copy()
-        headers["Content-Profile"] = self._schema
-        headers["Content-Type"] = "application/json"
-        
         query_params = {key: f"eq.{value}" for key, value in match.items()}
-        
+
         try:
-            response = await self._client.patch(
-                f"{self._url}/{table}",
-                params=query_params,
-                json=new_data,
-                headers=headers
+            # Setting columns to fixed values on an exact match is idempotent, so it is safe to retry
+            response = await self._request(
+                "UPDATE", table, "PATCH", table, idempotent=True,
+                params=query_params, json=new_data, headers=self._update_headers, timeout=self._write_timeout,
             )
-            response.raise_for_status()
             if response.status_code == 204:
                 return True
             return response.json()
-        except httpx.HTTPStatusError as e:
-            logging.error(f"HTTP error during UPDATE on '{table}': {e.response.status_code} - {e.response.text}")
-            return None
-        except Exception as e:
-            logging.error(f"Unexpected error during UPDATE on '{table}': {e}", exc_info=True)
+        except SupabaseError as e:
+            logging.error(str(e))
             return None
 
 # Initialize the HTTP client instance for global use
-supabase_http_client = SupabaseHttpClient(url=SUPABASE_URL, key=SUPABASE_KEY, schema=SCHEMA_NAME)
+supabase_http_client = SupabaseHttpClient(
+    url=SUPABASE_URL,
+    key=SUPABASE_KEY,
+    schema=SCHEMA_NAME,
+    max_connections=SUPABASE_MAX_CONNECTIONS,
+    max_keepalive_connections=SUPABASE_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+    connect_timeout=SUPABASE_CONNECT_TIMEOUT,
+    read_timeout=SUPABASE_READ_TIMEOUT,
+    write_timeout=SUPABASE_WRITE_TIMEOUT,
+    http2=SUPABASE_HTTP2,
+    retry_attempts=SUPABASE_RETRY_ATTEMPTS,
+    circuit_failure_threshold=SUPABASE_CIRCUIT_FAILURE_THRESHOLD,
+    circuit_reset_timeout=SUPABASE_CIRCUIT_RESET_TIMEOUT,
+)
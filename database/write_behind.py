@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_MAX_PENDING
+from database.resilience import RetryPolicy, SupabaseError
+from database.supabase_http_client import supabase_http_client
+
+# Buffered counter increments are keyed by RPC function name and its (sorted) key parameters
+CounterKey = Tuple[str, Tuple[Tuple[str, Any], ...], str]
+# Buffered upserts are keyed by table, conflict target and resolution
+UpsertKey = Tuple[str, str, bool]
+
+
+def _should_requeue(error: SupabaseError, idempotent: bool) -> bool:
+    """
+    Tells whether a failed write may be sent again.
+    An open circuit (no underlying error) means the request was never sent, so the write is kept.
+    Otherwise the client's retry rule applies: an insert or an RPC increment that timed out or got
+    a 5xx may already be applied, so it is only kept when the request never reached Supabase;
+    a 4xx such as an unknown column or a missing function will fail the same way every time.
+    """
+    cause = error.__cause__
+    return cause is None or RetryPolicy.is_retryable(cause, idempotent=idempotent)
+
+
+class WriteBehindQueue:
+    """
+    Buffers non-critical writes and flushes them in bulk, off the user-facing latency path.
+    Rows are grouped per table and sent as a single PostgREST bulk insert or upsert; upserts of the
+    same row are coalesced, and counter increments for the same key are summed and sent as one RPC call.
+    A flush happens when the buffer reaches max_batch rows, every flush_interval seconds, and on shutdown.
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int, max_pending: int):
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._max_pending = max_pending
+        self._rows: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._upserts: Dict[UpsertKey, Dict[Tuple[Any, ...], Dict[str, Any]]] = defaultdict(dict)
+        self._counters: Dict[CounterKey, int] = defaultdict(int)
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending + len(self._counters)
+
+    def insert(self, table: str, row: Dict[str, Any]) -> None:
+        """
+        Buffers a row to be inserted into a table.
+        """
+        if self._pending >= self._max_pending:
+            logging.error(f"Write-behind buffer is full ({self._pending} rows), dropping a row for '{table}'.")
+            return
+        self._rows[table].append(row)
+        self._pending += 1
+        self._maybe_flush()
+
+    def upsert(self, table: str, row: Dict[str, Any], on_conflict: str, ignore_duplicates: bool = False) -> None:
+        """
+        Buffers a row to be upserted into a table.
+        A later upsert of the same row (same on_conflict values) replaces the buffered one.
+        """
+        rows = self._upserts[(table, on_conflict, ignore_duplicates)]
+        conflict_values = tuple(row.get(column) for column in on_conflict.split(","))
+        if conflict_values not in rows:
+            if self._pending >= self._max_pending:
+                logging.error(f"Write-behind buffer is full ({self._pending} rows), dropping an upsert for '{table}'.")
+                return
+            self._pending += 1
+        rows[conflict_values] = row
+        self._maybe_flush()
+
+    def increment(self, function_name: str, key_params: Dict[str, Any], amount: int = 1, amount_param: str = "increment_value") -> None:
+        """
+        Buffers a counter increment performed by an RPC function.
+        Increments with the same function and key parameters are summed into one call.
+        """
+        key = (function_name, tuple(sorted(key_params.items())), amount_param)
+        if key not in self._counters and self.pending >= self._max_pending:
+            logging.error(f"Write-behind buffer is full ({self.pending} writes), dropping an increment of {function_name}.")
+            return
+        self._counters[key] += amount
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if self.pending >= self._max_batch and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        """
+        Sends everything buffered so far. Writes that failed for a transient reason and are safe to
+        send again are put back for the next flush; the others are dropped with an error.
+        """
+        async with self._flush_lock:
+            rows, self._rows = self._rows, defaultdict(list)
+            upserts, self._upserts = self._upserts, defaultdict(dict)
+            counters, self._counters = self._counters, defaultdict(int)
+            self._pending = 0
+
+            for table, table_rows in rows.items():
+                for start in range(0, len(table_rows), self._max_batch):
+                    batch = table_rows[start:start + self._max_batch]
+                    try:
+                        await supabase_http_client.bulk_insert(table, batch, raise_errors=True)
+                        logging.info(f"Write-behind flushed {len(batch)} rows into '{table}'.")
+                    except SupabaseError as e:
+                        if _should_requeue(e, idempotent=False):
+                            logging.warning(f"Write-behind will retry {len(batch)} rows for '{table}': {e}")
+                            self._requeue_rows(table, batch)
+                        else:
+                            logging.error(f"Write-behind dropped {len(batch)} rows for '{table}', not safe to retry: {e}")
+
+            for (table, on_conflict, ignore_duplicates), buffered in upserts.items():
+                items = list(buffered.items())
+                for start in range(0, len(items), self._max_batch):
+                    batch = items[start:start + self._max_batch]
+                    try:
+                        await supabase_http_client.upsert(
+                            table, [row for _, row in batch], on_conflict=on_conflict,
+                            ignore_duplicates=ignore_duplicates, raise_errors=True,
+                        )
+                        logging.info(f"Write-behind flushed {len(batch)} upserts into '{table}'.")
+                    except SupabaseError as e:
+                        if _should_requeue(e, idempotent=True):
+                            logging.warning(f"Write-behind will retry {len(batch)} upserts for '{table}': {e}")
+                            self._requeue_upserts((table, on_conflict, ignore_duplicates), batch)
+                        else:
+                            logging.error(f"Write-behind dropped {len(batch)} upserts rejected by '{table}': {e}")
+
+            for (function_name, key_items, amount_param), amount in counters.items():
+                params = {**dict(key_items), amount_param: amount}
+                try:
+                    await supabase_http_client.rpc(function_name, params=params, raise_errors=True)
+                except SupabaseError as e:
+                    if _should_requeue(e, idempotent=False):
+                        logging.warning(f"Write-behind will retry counter {function_name}{dict(key_items)}: {e}")
+                        self._requeue_counter((function_name, key_items, amount_param), amount)
+                    else:
+                        logging.error(f"Write-behind dropped counter {function_name}{dict(key_items)} (+{amount}), not safe to retry: {e}")
+
+    def _requeue_rows(self, table: str, batch: List[Dict[str, Any]]) -> None:
+        free = self._max_pending - self._pending
+        if free < len(batch):
+            logging.error(f"Write-behind buffer is full, dropping {len(batch) - max(free, 0)} rows for '{table}'.")
+            batch = batch[:max(free, 0)]
+        self._rows[table][:0] = batch
+        self._pending += len(batch)
+
+    def _requeue_upserts(self, key: UpsertKey, batch: List[Tuple[Tuple[Any, ...], Dict[str, Any]]]) -> None:
+        rows = self._upserts[key]
+        for conflict_values, row in batch:
+            # A newer upsert of the same row buffered during the flush wins
+            if conflict_values in rows:
+                continue
+            if self._pending >= self._max_pending:
+                logging.error(f"Write-behind buffer is full, dropping an upsert for '{key[0]}'.")
+                continue
+            rows[conflict_values] = row
+            self._pending += 1
+
+    def _requeue_counter(self, key: CounterKey, amount: int) -> None:
+        # Increments of the same key buffered during the flush are merged without taking another slot
+        if key not in self._counters and self.pending >= self._max_pending:
+            logging.error(f"Write-behind buffer is full, dropping counter {key[0]}{dict(key[1])} (+{amount}).")
+            return
+        self._counters[key] += amount
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self.pending:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logging.error(f"Write-behind flush failed: {e}", exc_info=True)
+
+    def start(self) -> None:
+        """
+        Starts the periodic background flush.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic flush and sends whatever is still buffered.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.pending:
+            await self.flush()
+        if self.pending:
+            logging.error(f"Write-behind could not flush {self.pending} pending writes on shutdown.")
+
+
+# Initialize the write-behind queue instance for global use
+write_behind = WriteBehindQueue(
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    max_batch=WRITE_BEHIND_MAX_BATCH,
+    max_pending=WRITE_BEHIND_MAX_PENDING,
+)
@@ -1,14 +1,18 @@
 import logging
-from aiogram import F, Router
+import re
+from aiogram import F, Router, Bot
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from handlers.catalog import get_workflows_from_db # To get workflows for selection
 
 from config import ADMIN_IDS
 from keyboards.inline import get_admin_panel_keyboard
 from database.supabase_http_client import supabase_http_client
+from database.catalog_cache import catalog_cache, get_workflows_from_db, get_workflow_by_slug # To get workflows for selection
+from database.ban_list import ban_list
+from database.models import WorkflowUpdate
+from utils.broadcast import Broadcast, broadcaster
 
 router = Router()
 
@@ -23,6 +27,12 @@ class ChangePrice(StatesGroup):
     waiting_for_workflow_slug = State()
     waiting_for_new_price = State()
 
+class SendUpdate(StatesGroup):
+    waiting_for_workflow_slug = State()
+    waiting_for_version = State()
+    waiting_for_changelog = State()
+    waiting_for_mode = State()
+
 @router.callback_query(F.data == "admin_panel", IS_ADMIN)
 async def cmd_admin_panel(callback: CallbackQuery, state: FSMContext):
     """
@@ -74,11 +84,17 @@ async def process_ban_reason(message: Message, state: FSMContext):
     user_id_to_ban = user_data['user_id_to_ban']
     
     try:
-        await supabase_http_client.insert("banned_users", {
+        banned = await supabase_http_client.insert("banned_users", {
             "telegram_id": user_id_to_ban,
             "reason": reason,
             "banned_by": str(message.from_user.id)
         })
+        if banned is None:
+            # Only a saved ban reaches the other replicas and survives a restart
+            await message.answer(f"❌ Не удалось сохранить бан пользователя {user_id_to_ban} в базе. Попробуйте еще раз.")
+            logging.error(f"Failed to save the ban of user {user_id_to_ban}.")
+            return
+        await ban_list.add(user_id_to_ban)
         await message.answer(f"✅ Пользователь {user_id_to_ban} успешно забанен.")
         logging.info(f"Admin {message.from_user.id} banned user {user_id_to_ban} with reason: {reason}")
     except Exception as e:
@@ -159,11 +175,16 @@ async def process_new_price(message: Message, state: FSMContext):
     slug = user_data['workflow_slug_to_change']
     
     try:
-        await supabase_http_client.update(
+        updated = await supabase_http_client.update(
             "workflows",
             match={"slug": slug},
             new_data={"price": new_price}
         )
+        if updated is None:
+            await message.answer(f"❌ Не удалось сохранить новую цену для workflow `{slug}`. Попробуйте еще раз.")
+            logging.error(f"Failed to save the new price for {slug}.")
+            return
+        await catalog_cache.invalidate_everywhere()
         
         await message.answer(f"✅ Цена для workflow `{slug}` успешно изменена на {new_price}₽.")
         logging.info(f"Admin {message.from_user.id} changed price for {slug} to {new_price}")
@@ -177,3 +198,160 @@ async def process_new_price(message: Message, state: FSMContext):
             "<b>Панель администратора</b>",
             reply_markup=get_admin_panel_keyboard()
         )
+
+
+# --- Send Update (Broadcast) FSM Handlers ---
+
+@router.callback_query(F.data == "admin:send_file", IS_ADMIN)
+async def start_send_update(callback: CallbackQuery, state: FSMContext):
+    """
+    Starts the process of announcing a workflow update to its buyers.
+    """
+    await callback.answer()
+
+    workflows = await get_workflows_from_db()
+    if not workflows:
+        await callback.message.edit_text("В базе данных нет workflows для рассылки обновления.")
+        return
+
+    buttons = []
+    for wf in workflows:
+        buttons.append([InlineKeyboardButton(
+            text=f"{wf.name} (v{wf.version})",
+            callback_data=f"sendupdate_wf:{wf.slug}"
+        )])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")])
+
+    await callback.message.edit_text(
+        "Выберите workflow, обновление которого нужно разослать покупателям:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+    )
+    await state.set_state(SendUpdate.waiting_for_workflow_slug)
+
+@router.callback_query(SendUpdate.waiting_for_workflow_slug, F.data.startswith("sendupdate_wf:"), IS_ADMIN)
+async def process_workflow_selection_for_update(callback: CallbackQuery, state: FSMContext):
+    """
+    Handles the selection of the updated workflow.
+    """
+    await callback.answer()
+    slug = callback.data.split(":")[1]
+
+    await state.update_data(update_slug=slug)
+
+    await callback.message.edit_text(f"Введите новую версию для workflow `{slug}` (например, `1.1`):")
+    await state.set_state(SendUpdate.waiting_for_version)
+
+@router.message(SendUpdate.waiting_for_version, IS_ADMIN)
+async def process_update_version(message: Message, state: FSMContext):
+    """
+    Processes the new version number.
+    """
+    version = message.text.strip() if message.text else ""
+    if not re.fullmatch(r"[\w.\-]{1,32}", version):
+        await message.answer("Неверный формат версии. Используйте буквы, цифры, точки и дефисы. Попробуйте еще раз.")
+        return
+
+    await state.update_data(update_version=version)
+    await message.answer("Версия принята. Теперь введите список изменений (можно отправить '-' для пропуска):")
+    await state.set_state(SendUpdate.waiting_for_changelog)
+
+@router.message(SendUpdate.waiting_for_changelog, IS_ADMIN)
+async def process_update_changelog(message: Message, state: FSMContext):
+    """
+    Processes the changelog and asks whether to send the updated file.
+    """
+    changelog = message.html_text.strip() if message.text else "-"
+    await state.update_data(update_changelog=None if changelog == '-' else changelog)
+
+    await message.answer(
+        "Как уведомить покупателей?",
+        reply_markup=get_update_mode_keyboard()
+    )
+    await state.set_state(SendUpdate.waiting_for_mode)
+
+def get_update_mode_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📎 Отправить обновленный файл", callback_data="sendupdate_mode:file")],
+        [InlineKeyboardButton(text="✉️ Только уведомление", callback_data="sendupdate_mode:notify")],
+        [InlineKeyboardButton(text="⬅️ Отмена", callback_data="admin_panel")]
+    ])
+
+@router.callback_query(SendUpdate.waiting_for_mode, F.data.startswith("sendupdate_mode:"), IS_ADMIN)
+async def process_update_mode(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    """
+    Records the WorkflowUpdate and starts the broadcast in the background.
+    If the update can't be saved, the FSM state is kept so the admin can press the button again.
+    """
+    await callback.answer()
+    send_file = callback.data.split(":")[1] == "file"
+    user_data = await state.get_data()
+    slug = user_data['update_slug']
+    show_panel = True
+
+    try:
+        workflow = await get_workflow_by_slug(slug)
+        if not workflow:
+            await state.clear()
+            await callback.message.edit_text(f"❌ Workflow `{slug}` не найден.")
+            return
+
+        update = WorkflowUpdate(
+            workflow_id=workflow.id,
+            version=user_data['update_version'],
+            changelog=user_data['update_changelog'],
+        )
+        # A retry after a failed version update must not record the same update twice
+        if not user_data.get('update_recorded'):
+            recorded = await supabase_http_client.insert("workflow_updates", {
+                "workflow_id": update.workflow_id,
+                "version": update.version,
+                "changelog": update.changelog,
+                "update_price": update.update_price,
+                "released_at": update.released_at.isoformat(),
+            })
+            if recorded is None:
+                show_panel = False
+                await callback.message.edit_text(
+                    "❌ Не удалось сохранить обновление в базе. Рассылка не запущена, попробуйте еще раз.",
+                    reply_markup=get_update_mode_keyboard()
+                )
+                return
+            await state.update_data(update_recorded=True)
+
+        updated = await supabase_http_client.update("workflows", match={"id": workflow.id}, new_data={"version": update.version})
+        if updated is None:
+            show_panel = False
+            await callback.message.edit_text(
+                "❌ Не удалось обновить версию workflow. Рассылка не запущена, попробуйте еще раз.",
+                reply_markup=get_update_mode_keyboard()
+            )
+            return
+        await state.clear()
+        await catalog_cache.invalidate_everywhere()
+
+        broadcast = Broadcast(
+            id=f"workflow-{workflow.id}-v{update.version}",
+            workflow_id=workflow.id,
+            workflow_name=workflow.name,
+            slug=workflow.slug,
+            filepath=workflow.filepath,
+            version=update.version,
+            changelog=update.changelog,
+            send_file=send_file,
+            admin_chat_id=callback.from_user.id,
+        )
+        if await broadcaster.start(bot, broadcast):
+            await callback.message.edit_text("🚀 Рассылка запущена. Отчет придет по ее завершении.")
+            logging.info(f"Admin {callback.from_user.id} started broadcast {broadcast.id}")
+        else:
+            await callback.message.edit_text("⏳ Эта рассылка уже выполняется.")
+    except Exception as e:
+        await state.clear()
+        await callback.message.edit_text(f"❌ Произошла ошибка при запуске рассылки: {e}")
+        logging.error(f"Failed to start update broadcast for {slug}: {e}")
+    finally:
+        if show_panel:
+            await callback.message.answer(
+                "<b>Панель администратора</b>",
+                reply_markup=get_admin_panel_keyboard()
+            )
@@ -1,44 +1,25 @@
 import logging
 from aiogram import Router, F, Bot
+from cachetools import LRUCache
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramBadRequest
 
-from database.supabase_http_client import supabase_http_client
-from database.models import Workflow
+from database.catalog_cache import catalog_cache, CatalogPage, get_workflow_by_slug
 # Import both keyboard functions
-from keyboards.inline import get_main_catalog_keyboard, get_filtered_catalog_keyboard, get_workflow_card_keyboard
+from keyboards.inline import get_main_catalog_keyboard, get_filtered_catalog_keyboard
 from utils.pricing import get_current_price
+from utils.cards import RenderedView, card_cache, edit_view
+from utils.metrics import cache_requests
+from config import CATALOG_PAGE_SIZE, CATALOG_KEYBOARD_CACHE_SIZE
 
 router = Router()
 
-async def get_workflows_from_db(priority: int = None) -> list[Workflow]:
-    """
-    Fetches a list of active workflows from the database.
-    """
-    params = {"is_active": "eq.true", "order": "priority.asc,name.asc"}
-    if priority:
-        params["priority"] = f"eq.{priority}"
-    
-    try:
-        response = await supabase_http_client.select(table="workflows", params=params)
-        return [Workflow(**wf) for wf in response]
-    except Exception as e:
-        logging.error(f"Error fetching workflows from DB: {e}", exc_info=True)
-        return []
-        
-async def get_workflow_by_slug(slug: str) -> Workflow | None:
-    """
-    Fetches a single workflow by its unique slug.
-    """
-    try:
-        params = {"slug": f"eq.{slug}", "select": "*", "limit": 1}
-        response = await supabase_http_client.select(table="workflows", params=params)
-        if response:
-            return Workflow(**response[0])
-        return None
-    except Exception as e:
-        logging.error(f"Error fetching workflow by slug '{slug}': {e}", exc_info=True)
-        return None
+CATALOG_MENU_VIEW = RenderedView(
+    text="🗂️ **Каталог Workflows**\n\nВыберите категорию:",
+    reply_markup=get_main_catalog_keyboard(),
+)
+
+# Rendered catalog page keyboards, keyed on the catalog version they were built from
+catalog_keyboards = LRUCache(maxsize=CATALOG_KEYBOARD_CACHE_SIZE)
 
 @router.callback_query(F.data == "catalog_menu")
 async def show_catalog_menu(callback: CallbackQuery, **kwargs):
@@ -47,34 +28,26 @@ async def show_catalog_menu(callback: CallbackQuery, **kwargs):
     """
     await callback.answer()
     
-    catalog_text = "🗂️ **Каталог Workflows**\n\nВыберите категорию:"
+    # Use the keyboard with filters (categories) here
+    await edit_view(callback.message, CATALOG_MENU_VIEW)
 
-    try:
-        # Use the keyboard with filters (categories) here
-        await callback.message.edit_text(
-            text=catalog_text,
-            reply_markup=get_main_catalog_keyboard()
-        )
-    except TelegramBadRequest:
-        logging.warning("Tried to edit message with the same content in show_catalog_menu.")
-
-@router.callback_query(F.data.startswith("filter_priority:"))
-async def filter_workflows_by_priority(callback: CallbackQuery):
+async def show_catalog_page(callback: CallbackQuery, filter_value: str, after_id: int = None, before_id: int = None):
     """
-    Shows a filtered list of workflows without filter buttons.
+    Shows one page of a filtered list of workflows, without filter buttons.
     """
-    await callback.answer()
-    filter_value = callback.data.split(":")[1]
-    
     priority_filter = None
     if filter_value != "all":
         try:
             priority_filter = int(filter_value)
         except ValueError:
             logging.error(f"Invalid priority filter value: {filter_value}")
-            pass
+            filter_value = "all"
 
-    workflows = await get_workflows_from_db(priority_filter)
+    try:
+        page = await catalog_cache.get_page(priority_filter, after_id=after_id, before_id=before_id, limit=CATALOG_PAGE_SIZE)
+    except Exception as e:
+        logging.error(f"Error fetching a catalog page: {e}", exc_info=True)
+        page = CatalogPage(workflows=[], has_prev=False, has_next=False)
     current_price = await get_current_price()
 
     catalog_text = ""
@@ -87,18 +60,55 @@ async def filter_workflows_by_priority(callback: CallbackQuery):
     else:
         catalog_text = "🗂️ **Все Workflows**\n\n"
 
-    if not workflows:
+    if not page.workflows:
         catalog_text += "В этой категории пока нет workflows."
     else:
         catalog_text += "Выберите интересующий вас workflow:"
 
-    try:
-        await callback.message.edit_text(
-            text=catalog_text,
-            reply_markup=get_filtered_catalog_keyboard(workflows, current_price)
+    # Keyboards cut from the cached catalog are reused until the catalog or the price changes
+    key = (page.version, filter_value, after_id, before_id, current_price)
+    keyboard = catalog_keyboards.get(key) if page.version is not None else None
+    cache_requests.inc("catalog_keyboards", "miss" if keyboard is None else "hit")
+    if keyboard is None:
+        keyboard = get_filtered_catalog_keyboard(
+            page.workflows, current_price,
+            prev_data=f"catalog_page:{filter_value}:b{page.workflows[0].id}" if page.has_prev and page.workflows else None,
+            next_data=f"catalog_page:{filter_value}:a{page.workflows[-1].id}" if page.has_next and page.workflows else None,
         )
-    except TelegramBadRequest:
-        logging.warning("Tried to edit message with the same content in filter_workflows_by_priority.")
+        if page.version is not None:
+            catalog_keyboards[key] = keyboard
+
+    # Cards of the listed workflows are rendered now, so opening one does no formatting work
+    card_cache.warm(page.workflows, current_price, catalog_cache.version)
+    await edit_view(callback.message, RenderedView(text=catalog_text, reply_markup=keyboard))
+
+@router.callback_query(F.data.startswith("filter_priority:"))
+async def filter_workflows_by_priority(callback: CallbackQuery):
+    """
+    Shows the first page of a filtered list of workflows.
+    """
+    await callback.answer()
+    filter_value = callback.data.split(":")[1]
+    await show_catalog_page(callback, filter_value)
+
+@router.callback_query(F.data.startswith("catalog_page:"))
+async def turn_catalog_page(callback: CallbackQuery):
+    """
+    Shows the next or previous page of a filtered list of workflows.
+    The page token is 'a<id>' (after workflow id) or 'b<id>' (before workflow id).
+    """
+    await callback.answer()
+    _, filter_value, token = callback.data.split(":")
+    try:
+        anchor_id = int(token[1:])
+    except ValueError:
+        logging.error(f"Invalid catalog page token: {token}")
+        anchor_id = None
+
+    if token.startswith("b"):
+        await show_catalog_page(callback, filter_value, before_id=anchor_id)
+    else:
+        await show_catalog_page(callback, filter_value, after_id=anchor_id)
 
 @router.callback_query(F.data.startswith("workflow:"))
 async def show_workflow_card(callback: CallbackQuery):
@@ -115,18 +125,4 @@ async def show_workflow_card(callback: CallbackQuery):
         return
 
     current_price = await get_current_price()
-        
-    card_text = (
-        f"📄 **{workflow.name}**\n\n"
-        f"<b>Описание:</b> {workflow.description}\n\n"
-        f"<b>Версия:</b> {workflow.version}\n"
-        f"<b>Цена:</b> {current_price:.0f}₽"
-    )
-    
-    try:
-        await callback.message.edit_text(
-            text=card_text,
-            reply_markup=get_workflow_card_keyboard(slug, current_price)
-        )
-    except TelegramBadRequest:
-        logging.warning("Tried to edit message with the same content in show_workflow_card.")
+    await edit_view(callback.message, card_cache.get(workflow, current_price, catalog_cache.version))
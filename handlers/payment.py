@@ -1,20 +1,24 @@
 import logging
-import os
-from datetime import datetime, timedelta
+import time
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from utils.watermark import add_watermark_to_workflow
+from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
 
-from config import YUKASSA_TOKEN, PRIVATE_CHANNEL_ID
-from handlers.catalog import get_workflow_by_slug
-from database.supabase_http_client import supabase_http_client
-from utils.pricing import get_current_price, PRICE_EARLY_BIRD
-from utils.watermark import add_watermark_to_workflow
-from utils.encryption import encryptor # Import the encryptor # Import watermarking function
-from aiogram.types import FSInputFile # Import for sending files
+from config import YUKASSA_TOKEN
+from database.catalog_cache import get_workflow_by_slug
+from database.idempotency import payment_deduplicator
+from utils.pricing import get_current_price
+from utils.encryption import encryptor # Import the encryptor
+from utils.fulfillment import fulfillment
+from utils.metrics import metrics
 
 router = Router()
 
+PAYMENTS = metrics.counter(
+    "bot_payments_total",
+    "Payment events: invoice, pre_checkout, paid, duplicate, failed (could not be queued).",
+    ("event",),
+)
+
 @router.callback_query(F.data.startswith("buy:"))
 async def handle_buy_workflow(callback: CallbackQuery, bot: Bot):
     """
@@ -61,6 +65,7 @@ async def handle_buy_workflow(callback: CallbackQuery, bot: Bot):
         reply_markup=None,
         request_timeout=15,
     )
+    PAYMENTS.inc("invoice")
     await callback.answer() # Acknowledge the button press
 
 @router.pre_checkout_query()
@@ -71,16 +76,14 @@ async def handle_pre_checkout_query(pre_checkout_query: PreCheckoutQuery, bot: B
     """
     # For now, we'll always approve the transaction.
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    PAYMENTS.inc("pre_checkout")
     logging.info(f"Pre-checkout query approved for user {pre_checkout_query.from_user.id}")
 
-import os
-
-# ... (other imports) ...
-
 @router.message(F.successful_payment)
 async def handle_successful_payment(message: Message, bot: Bot):
     """
-    Handles a successful payment, saves the purchase, creates a watermark, and delivers the product.
+    Handles a successful payment: records it in the durable fulfillment queue and acknowledges it.
+    Saving the purchase, watermarking and delivery are done by the fulfillment workers.
     """
     payment_info = message.successful_payment
     payload_str = payment_info.invoice_payload
@@ -89,88 +92,38 @@ async def handle_successful_payment(message: Message, bot: Bot):
 
     logging.info(f"SUCCESSFUL PAYMENT from user {user_id} for payload: {payload_str}")
 
+    # Redelivered updates for the same charge stop here, before any DB write or watermarking
+    payment_hash = await payment_deduplicator.claim(payment_info.telegram_payment_charge_id)
+    if payment_hash is None:
+        PAYMENTS.inc("duplicate")
+        logging.warning(f"Duplicate successful payment update from user {user_id} for payload {payload_str} ignored.")
+        return
+
     try:
         _, slug, _ = payload_str.split(":")
-        
-        workflow = await get_workflow_by_slug(slug)
-        if not workflow:
-            logging.error(f"FATAL: Workflow '{slug}' not found after successful payment!")
-            await message.answer("Произошла критическая ошибка. Свяжитесь с поддержкой.")
-            return
 
-        # Save purchase to DB
-        purchase_data = {
-            "user_id": user_id, "workflow_id": workflow.id,
+        # The workflow is looked up by the worker, so a Supabase outage cannot lose a paid order here
+        job_payload = {
+            "user_id": user_id, "username": username,
+            "slug": slug,
             "price": payment_info.total_amount / 100,
-            "payment_id": encryptor.encrypt(payment_info.telegram_payment_charge_id),
+            # The queue lives on local disk, so the charge id is only stored encrypted
+            "payment_id": await encryptor.encrypt_async(payment_info.telegram_payment_charge_id),
             "email": payment_info.order_info.email if payment_info.order_info else None,
+            # Lets the workers measure the time from payment to delivery
+            "paid_at": time.time(),
         }
-        await supabase_http_client.insert(table="purchases", data=purchase_data)
-        logging.info(f"Purchase by user {user_id} for workflow {workflow.id} saved to DB.")
-
-        # Increment Early Bird counter if applicable
-        if (payment_info.total_amount / 100) == PRICE_EARLY_BIRD:
-            await supabase_http_client.rpc('increment_setting_value', params={'setting_key': 'early_bird_counter', 'increment_value': 1})
-            logging.info("Incremented early_bird_counter.")
-
-        # --- Deliver the product ---
-        await message.answer("🎉 Спасибо за покупку! Готовлю ваш персональный файл...")
-
-        watermarked_file = add_watermark_to_workflow(
-            original_filepath=workflow.filepath, slug=workflow.slug,
-            user_id=user_id, username=username,
-            payment_id=payment_info.telegram_payment_charge_id,
-            workflow_version=workflow.version
-        )
-
-        if watermarked_file:
-            try:
-                await bot.send_document(
-                    chat_id=user_id,
-                    document=FSInputFile(watermarked_file),
-                    caption="✅ Ваш workflow готов! Спасибо за использование нашего сервиса."
-                )
-                logging.info(f"Successfully sent watermarked file to user {user_id}")
-            finally:
-                # Cleanup the temporary watermarked file
-                os.remove(watermarked_file)
-                logging.info(f"Removed temporary file: {watermarked_file}")
+        if await fulfillment.enqueue(payment_hash, job_payload):
+            PAYMENTS.inc("paid")
         else:
-            raise Exception("Watermarked file creation failed.")
-
-        # --- Send Invite Link ---
-        try:
-            if PRIVATE_CHANNEL_ID:
-                expire_date = datetime.now() + timedelta(days=1)
-                invite_link = await bot.create_chat_invite_link(
-                    chat_id=PRIVATE_CHANNEL_ID,
-                    expire_date=expire_date,
-                    member_limit=1
-                )
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=f"🎁 В качестве бонуса, вот ваше персональное приглашение в наш приватный канал. Ссылка действует 24 часа:\n{invite_link.invite_link}"
-                )
-                logging.info(f"Sent invite link to user {user_id}")
-            else:
-                logging.warning("PRIVATE_CHANNEL_ID is not set. Skipping invite link generation.")
-        except Exception as e:
-            logging.error(f"Failed to create or send invite link for user {user_id}: {e}")
-            # Do not block the user, just inform them
-            await bot.send_message(user_id, "Не удалось создать пригласительную ссылку в приватный канал. Если проблема повторится, пожалуйста, обратитесь в поддержку.")
-
+            PAYMENTS.inc("duplicate")
+            logging.warning(f"Payment {payment_hash[:12]} from user {user_id} is already being fulfilled.")
+        payment_deduplicator.complete(payment_hash)
     except Exception as e:
-        logging.error(f"Failed to process successful payment for user {user_id}: {e}", exc_info=True)
+        logging.error(f"Failed to queue successful payment for user {user_id}: {e}", exc_info=True)
+        payment_deduplicator.release(payment_hash)
+        PAYMENTS.inc("failed")
         await message.answer("😔 Произошла ошибка при обработке вашей покупки. Пожалуйста, свяжитесь с поддержкой, и мы все решим.")
         return
 
-    # Final confirmation message with a button
-    await message.answer(
-        "Все готово! Если у вас возникнут вопросы, обращайтесь в поддержку.",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🏠 На главную", callback_data="main_menu"),
-                InlineKeyboardButton(text="💬 Поддержка", callback_data="support_menu")
-            ]
-        ])
-    )
+    await message.answer("🎉 Спасибо за покупку! Готовлю ваш персональный файл...")
@@ -6,14 +6,20 @@ from html import escape
 import logging
 
 from keyboards.inline import get_main_menu_keyboard
-from config import ADMIN_IDS # Import admin IDs
+from config import ADMIN_IDS, KNOWN_USERS_CACHE_SIZE # Import admin IDs
 # Import functions needed for showing a workflow card
-from handlers.catalog import get_workflow_by_slug, get_workflow_card_keyboard
-from database.supabase_http_client import supabase_http_client
+from database.catalog_cache import catalog_cache, get_workflow_by_slug
+from utils.cards import card_cache
+from utils.pricing import get_current_price
+from database.write_behind import write_behind
 from database.models import User
+from cachetools import LRUCache
 
 router = Router()
 
+# Telegram IDs already registered by this process (bounded, least recently used are evicted)
+known_users = LRUCache(maxsize=KNOWN_USERS_CACHE_SIZE)
+
 @router.message(CommandStart())
 
 async def handle_start(message: Message, bot: Bot, command: CommandObject):
@@ -58,25 +64,9 @@ async def handle_start(message: Message, bot: Bot, command: CommandObject):
 
             current_price = await get_current_price() # Get dynamic price
 
-            card_text = (
-
-                f"📄 **{workflow.name}**\n\n"
-
-                f"<b>Описание:</b> {workflow.description}\n\n"
-
-                f"<b>Версия:</b> {workflow.version}\n"
-
-                f"<b>Цена:</b> {current_price:.0f}₽"
-
-            )
-
-            await message.answer(
-
-                text=card_text,
-
-                reply_markup=get_workflow_card_keyboard(slug, current_price)
+            card = card_cache.get(workflow, current_price, catalog_cache.version)
 
-            )
+            await message.answer(text=card.text, reply_markup=card.reply_markup)
 
             return # Stop further execution
 
@@ -90,39 +80,24 @@ async def handle_start(message: Message, bot: Bot, command: CommandObject):
 
     # --- Standard Start & User Registration ---
 
-    try:
+    # Users already seen by this process are skipped entirely; everyone else gets a single
+    # buffered upsert that leaves existing rows untouched, so there is no select and no race.
 
-        existing_users = await supabase_http_client.select(
+    if user_id not in known_users:
 
-            table="users",
+        user_data = {
 
-            params={"telegram_id": f"eq.{user_id}", "select": "telegram_id"}
+            'telegram_id': user_id, 'username': username,
 
-        )
+            'registered_at': User(telegram_id=user_id).registered_at.isoformat(),
 
-        if not existing_users:
-
-            logging.info(f"New user: {username} ({user_id}). Registering...")
-
-            user_data = {
-
-                'telegram_id': user_id, 'username': username,
-
-                'registered_at': User(telegram_id=user_id).registered_at.isoformat(),
-
-            }
-
-            await supabase_http_client.insert(table="users", data=user_data)
-
-            logging.info(f"User {username} ({user_id}) registered successfully.")
-
-        else:
+        }
 
-            logging.info(f"User {username} ({user_id}) is already registered.")
+        write_behind.upsert("users", user_data, on_conflict="telegram_id", ignore_duplicates=True)
 
-    except Exception as e:
+        known_users[user_id] = True
 
-        logging.error(f"Error during user registration for {username} ({user_id}): {e}", exc_info=True)
+        logging.info(f"User {username} ({user_id}) queued for registration.")
 
 
 
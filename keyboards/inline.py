@@ -1,5 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import List
+from typing import List, Optional
 
 # Assuming Workflow is defined somewhere, for type hinting.
 # In a real scenario, you'd import it from database.models
@@ -59,9 +59,15 @@ def get_main_catalog_keyboard() -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_filtered_catalog_keyboard(workflows: List[Workflow], price: int) -> InlineKeyboardMarkup:
+def get_filtered_catalog_keyboard(
+    workflows: List[Workflow],
+    price: int,
+    prev_data: Optional[str] = None,
+    next_data: Optional[str] = None,
+) -> InlineKeyboardMarkup:
     """
-    Creates an inline keyboard for a filtered catalog view, showing a consistent price.
+    Creates an inline keyboard for one page of a filtered catalog view, showing a consistent price.
+    prev_data/next_data are the callback data of the neighbouring pages, if there are any.
     """
     buttons = []
     for wf in workflows:
@@ -70,6 +76,15 @@ def get_filtered_catalog_keyboard(workflows: List[Workflow], price: int) -> Inli
         callback_data = f"workflow:{wf.slug}"
         buttons.append([InlineKeyboardButton(text=button_text, callback_data=callback_data)])
 
+    # Page navigation
+    navigation = []
+    if prev_data:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data=prev_data))
+    if next_data:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=next_data))
+    if navigation:
+        buttons.append(navigation)
+
     # The "Back" button should now lead to the main catalog view
     buttons.append([
         InlineKeyboardButton(text="⬅️ Назад в каталог", callback_data="catalog_menu")
@@ -3,11 +3,15 @@ from aiogram import BaseMiddleware, Bot
 from aiogram.types import TelegramObject, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 import logging
 
-from database.supabase_http_client import supabase_http_client
+from database.ban_list import ban_list
+from utils.metrics import metrics
+
+BANNED_UPDATES = metrics.counter("bot_banned_updates_total", "Updates from banned users that were dropped.")
 
 class BanCheckMiddleware(BaseMiddleware):
     """
     Middleware to check if a user is in the banned_users table.
+    The check is served from the in-memory ban list, so it does not cost a database round-trip.
     If the user is banned, it informs them and stops processing the update.
     """
     async def __call__(
@@ -28,12 +32,8 @@ class BanCheckMiddleware(BaseMiddleware):
         user_id = user.id
 
         try:
-            banned_user = await supabase_http_client.select(
-                "banned_users", 
-                params={"telegram_id": f"eq.{user_id}", "select": "telegram_id", "limit": 1}
-            )
-
-            if banned_user:
+            if await ban_list.is_banned(user_id):
+                BANNED_UPDATES.inc()
                 logging.warning(f"Banned user {user_id} ({user.username}) tried to interact with the bot. Access denied.")
                 # Inform the user about the ban and provide a support button
                 bot: Bot = data['bot']
@@ -0,0 +1,33 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from utils.metrics import metrics
+
+HANDLER_SECONDS = metrics.histogram(
+    "bot_handler_duration_seconds", "Time spent in router handlers.", ("handler", "status")
+)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware that times every router handler.
+    Register it last, so only the handler itself is measured and not the ban or rate limit checks.
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        status = "error"
+        try:
+            result = await handler(event, data)
+            status = "ok"
+            return result
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name, status)
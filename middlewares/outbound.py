@@ -0,0 +1,245 @@
+import asyncio
+import heapq
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot, methods
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from cachetools import TTLCache
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES
+
+# Priority lanes, highest priority first
+LANES = ("delivery", "messages", "edits", "bulk")
+
+# Outgoing messages are governed; everything else (answers to queries, getUpdates, admin calls) passes through
+METHOD_LANES = {
+    methods.SendDocument: "delivery",
+    methods.SendInvoice: "delivery",
+    methods.SendMessage: "messages",
+    methods.SendPhoto: "messages",
+    methods.CopyMessage: "messages",
+    methods.ForwardMessage: "messages",
+    methods.EditMessageText: "edits",
+    methods.EditMessageReplyMarkup: "edits",
+    methods.EditMessageCaption: "edits",
+    methods.EditMessageMedia: "edits",
+}
+
+# Lets a caller move its sends to another lane, e.g. broadcasts to "bulk"
+_lane_override: ContextVar[Optional[str]] = ContextVar("outbound_lane", default=None)
+
+
+@contextmanager
+def send_lane(lane: str) -> Iterator[None]:
+    """
+    Sends made inside this block (in the current task) use the given priority lane.
+    """
+    token = _lane_override.set(lane)
+    try:
+        yield
+    finally:
+        _lane_override.reset(token)
+
+
+class SendTracker:
+    """
+    Records whether a call made inside track_sends() was handed to Telegram.
+    """
+
+    def __init__(self):
+        self.started = False
+
+
+# Set by track_sends(); the governor marks it right before a call goes out
+_send_tracker: ContextVar[Optional[SendTracker]] = ContextVar("outbound_send_tracker", default=None)
+
+
+@contextmanager
+def track_sends() -> Iterator[SendTracker]:
+    """
+    Tells apart a block cancelled before any call went out (e.g. while waiting for a token)
+    from one whose calls may have reached Telegram.
+    """
+    tracker = SendTracker()
+    token = _send_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _send_tracker.reset(token)
+
+
+class LaneStats:
+    """
+    Queueing delay counters of one lane.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def observe(self, wait: float) -> None:
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg_wait": self.total_wait / self.count if self.count else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class TelegramGovernor(BaseRequestMiddleware):
+    """
+    A request middleware on the bot session that keeps outgoing messages within Telegram's limits.
+    Every governed call waits for a token from its chat's bucket (about one message per second per chat)
+    and then from the global bucket (30 messages per second). Global tokens go to the highest priority
+    lane first, so payment delivery is not stuck behind a wave of catalog edits.
+    A 429 pauses the chat (or everything, if the call has no chat) for retry_after seconds and the
+    call is sent again, up to max_retries times.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3):
+        """
+        :param global_rate: Messages per second for the whole bot (also the burst size).
+        :param chat_rate: Messages per second for a single chat.
+        :param chat_burst: How many messages a chat may get at once.
+        :param max_retries: How many times a call is repeated after a 429.
+        """
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+
+        self._global_tokens = global_rate
+        self._global_updated_at = time.monotonic()
+        self._global_paused_until = 0.0
+        self._chats = TTLCache(maxsize=100_000, ttl=3600)
+        self._chat_paused_until = TTLCache(maxsize=100_000, ttl=3600)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+        # Metrics
+        self.lane_stats: Dict[str, LaneStats] = {lane: LaneStats() for lane in LANES}
+        self.retry_after_count = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "waiting": self.waiting,
+            "retry_after": self.retry_after_count,
+            "lanes": {lane: stats.as_dict() for lane, stats in self.lane_stats.items()},
+        }
+
+    # --- Per-chat buckets ---
+
+    def _reserve_chat(self, chat_id: Any) -> float:
+        """
+        Takes a token from the chat's bucket, possibly ahead of time. Returns how long to wait for it.
+        Reserving keeps a chat's messages in order without a queue per chat.
+        """
+        now = time.monotonic()
+        tokens, updated_at = self._chats.get(chat_id, (self._chat_burst, now))
+        tokens = min(self._chat_burst, tokens + (now - updated_at) * self._chat_rate) - 1
+        self._chats[chat_id] = (tokens, now)
+        wait = -tokens / self._chat_rate if tokens < 0 else 0.0
+        return max(wait, self._chat_paused_until.get(chat_id, 0.0) - now)
+
+    # --- Global bucket with priority lanes ---
+
+    def _global_wait(self) -> float:
+        now = time.monotonic()
+        self._global_tokens = min(
+            self._global_rate, self._global_tokens + (now - self._global_updated_at) * self._global_rate
+        )
+        self._global_updated_at = now
+        wait = (1 - self._global_tokens) / self._global_rate if self._global_tokens < 1 else 0.0
+        return max(wait, self._global_paused_until - now)
+
+    async def _acquire_global(self, lane: str) -> None:
+        if not self._waiters and self._global_wait() == 0:
+            self._global_tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (LANES.index(lane), next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            wait = self._global_wait()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # The caller gave up while waiting
+                continue
+            self._global_tokens -= 1
+            future.set_result(None)
+
+    # --- Middleware ---
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[Any],
+        bot: Bot,
+        method: TelegramMethod[Any],
+    ) -> Any:
+        lane = METHOD_LANES.get(type(method))
+        tracker = _send_tracker.get()
+        if lane is None:
+            if tracker is not None:
+                tracker.started = True
+            return await make_request(bot, method)
+        lane = _lane_override.get() or lane
+        chat_id = getattr(method, "chat_id", None)
+
+        for attempt in range(self._max_retries + 1):
+            started = time.monotonic()
+            if chat_id is not None:
+                wait = self._reserve_chat(chat_id)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await self._acquire_global(lane)
+            self.lane_stats[lane].observe(time.monotonic() - started)
+
+            if tracker is not None:
+                tracker.started = True
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                if attempt == self._max_retries:
+                    raise
+                paused_until = time.monotonic() + e.retry_after
+                if chat_id is not None:
+                    self._chat_paused_until[chat_id] = paused_until
+                else:
+                    self._global_paused_until = max(self._global_paused_until, paused_until)
+                logging.warning(
+                    f"Telegram flood control on {type(method).__name__} (chat {chat_id}), retrying in {e.retry_after}s."
+                )
+
+
+# Initialize the governor instance for global use
+telegram_governor = TelegramGovernor(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
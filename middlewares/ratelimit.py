@@ -1,39 +1,98 @@
-from typing import Any, Awaitable, Callable, Dict
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
 from aiogram import BaseMiddleware
-from aiogram.types import Message
-from cachetools import TTLCache
+from aiogram.types import TelegramObject, Message, CallbackQuery
+
+from database.shared_state import SharedState, LocalSharedState
+from utils.metrics import metrics
+
+RATE_LIMITED = metrics.counter(
+    "bot_rate_limited_updates_total", "Updates dropped by the rate limiter.", ("limiter", "scope")
+)
+
+
+class TokenBucketLimiter:
+    """
+    A token bucket per key: each key may spend up to `capacity` requests at once,
+    and gets `rate` tokens back per second.
+    Buckets live in a SharedState backend: in-process by default, or Redis so that
+    all bot replicas draw from the same budgets. Only (tokens, timestamp) is stored per active key.
+    """
+    def __init__(self, rate: float, capacity: float, state: Optional[SharedState] = None, namespace: str = "ratelimit"):
+        self.rate = rate
+        self.capacity = capacity
+        self._state = state or LocalSharedState()
+        self._namespace = namespace
+
+    async def consume(self, key: Hashable) -> bool:
+        """
+        Takes a token from the key's bucket. Returns False if the bucket is empty.
+        If the backend is unreachable the request is allowed, so an outage does not lock everyone out.
+        """
+        try:
+            return await self._state.take_token(f"{self._namespace}:{key}", self.rate, self.capacity)
+        except Exception as e:
+            logging.error(f"Rate limit backend error, allowing the request: {e}")
+            return True
+
 
 class RateLimitMiddleware(BaseMiddleware):
     """
-    A simple middleware to limit the rate of incoming messages from a user.
-    Uses a TTLCache to store user request times.
+    Limits the rate of incoming updates with token buckets.
+    Every user has their own budget for the event type this middleware is registered on
+    (messages and callback queries get separate instances), and an optional shared global
+    budget caps the total load the bot puts on the backend.
+    Successful payment messages are never throttled.
     """
-    def __init__(self, rate_limit: float = 2, time_period: int = 5):
+    def __init__(
+        self,
+        rate_limit: float = 2,
+        time_period: int = 5,
+        global_limiter: Optional[TokenBucketLimiter] = None,
+        name: str = "messages",
+        state: Optional[SharedState] = None,
+    ):
         """
-        :param rate_limit: Max number of requests per time_period.
+        :param rate_limit: Max number of requests per time_period (also the burst size).
         :param time_period: Time period in seconds.
+        :param global_limiter: A limiter shared by all users (and middleware instances).
+        :param name: A label for logs and counters (also namespaces the buckets).
+        :param state: Where the buckets are kept; defaults to in-process.
         """
-        self.limit = TTLCache(maxsize=10_000, ttl=time_period)
+        self.limiter = TokenBucketLimiter(
+            rate=rate_limit / time_period, capacity=rate_limit, state=state, namespace=f"ratelimit:{name}",
+        )
+        self.global_limiter = global_limiter
+        self.name = name
 
     async def __call__(
         self,
-        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-        event: Message,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        user_id = event.from_user.id
-        
-        # Check if user is already in the cache
-        if user_id in self.limit:
-            # If the user is in the cache, it means they have sent a request recently.
-            # We don't need to do anything special, just let the message pass.
-            # The cache will automatically handle the rate limiting logic.
-            # If the user sends too many requests, they will simply not be processed
-            # until the time-to-live (TTL) for their cache entry expires.
-            pass
-        
-        # Add/update the user's entry in the cache
-        self.limit[user_id] = None
+        user = data.get('event_from_user')
+        if not user or (isinstance(event, Message) and event.successful_payment):
+            return await handler(event, data)
+
+        if not await self.limiter.consume(user.id):
+            RATE_LIMITED.inc(self.name, "user")
+            logging.info(f"Rate limit ({self.name}) exceeded by user {user.id}. Update dropped.")
+            return await self._reject(event)
+
+        if self.global_limiter is not None and not await self.global_limiter.consume("global"):
+            RATE_LIMITED.inc(self.name, "global")
+            logging.warning(f"Global rate limit exceeded, dropping an update ({self.name}) from user {user.id}.")
+            return await self._reject(event)
 
         # Call the next handler in the chain
         return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: TelegramObject) -> None:
+        # Answer callback queries so the button does not keep spinning
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer("⏳ Слишком много запросов. Пожалуйста, подождите немного.")
+            except Exception as e:
+                logging.debug(f"Could not answer a throttled callback query: {e}")
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+
+class UpdateSchedulerMiddleware(BaseMiddleware):
+    """
+    Outer middleware on dp.update that schedules update processing:
+    - updates from the same user are processed one at a time, in arrival order,
+      so e.g. a double-tapped "buy" button never runs two handlers in parallel;
+    - updates from different users run in parallel, capped at max_in_flight handlers overall;
+    - when a user's queue or the global queue grows too long, new non-critical updates are shed.
+    Payment updates (pre-checkout queries and successful payments) are never shed.
+    """
+    def __init__(self, max_in_flight: int = 100, max_queued_per_user: int = 5, max_queued: int = 1000):
+        """
+        :param max_in_flight: Max number of updates being processed at the same time.
+        :param max_queued_per_user: Max number of updates a single user may have waiting.
+        :param max_queued: Max number of updates waiting overall.
+        """
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._max_queued_per_user = max_queued_per_user
+        self._max_queued = max_queued
+        # Per-user locks with the number of updates holding or waiting for them
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users_pending: Dict[Hashable, int] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        # Metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+
+    @staticmethod
+    def _is_critical(update: Update) -> bool:
+        return bool(update.pre_checkout_query or (update.message and update.message.successful_payment))
+
+    @staticmethod
+    def _get_key(data: Dict[str, Any]) -> Optional[Hashable]:
+        user = data.get('event_from_user')
+        if user:
+            return user.id
+        chat = data.get('event_chat')
+        return chat.id if chat else None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = self._get_key(data)
+        critical = isinstance(event, Update) and self._is_critical(event)
+
+        if key is not None and not critical:
+            if self._users_pending.get(key, 0) >= self._max_queued_per_user or self.queued >= self._max_queued:
+                self.shed += 1
+                logging.warning(f"Update scheduler overloaded, shedding an update from {key}.")
+                await self._reject(event)
+                return None
+
+        self.queued += 1
+        self._idle.clear()
+        lock = None
+        if key is not None:
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            self._users_pending[key] = self._users_pending.get(key, 0) + 1
+
+        started = False
+        try:
+            # The per-user lock is taken first, so waiting users do not hold global slots
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._semaphore:
+                    self.queued -= 1
+                    self.in_flight += 1
+                    started = True
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.in_flight -= 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if not started:
+                # Cancelled while waiting
+                self.queued -= 1
+            if key is not None:
+                self._users_pending[key] -= 1
+                if self._users_pending[key] == 0:
+                    # Nothing else is waiting for this user, drop the lock to keep memory bounded
+                    del self._users_pending[key]
+                    del self._locks[key]
+            if self.in_flight == 0 and self.queued == 0:
+                self._idle.set()
+
+    @staticmethod
+    async def _reject(event: TelegramObject) -> None:
+        # Answer shed callback queries so the button does not keep spinning
+        if isinstance(event, Update) and event.callback_query:
+            try:
+                await event.callback_query.answer("⏳ Бот сейчас перегружен. Пожалуйста, попробуйте через пару секунд.")
+            except Exception as e:
+                logging.debug(f"Could not answer a shed callback query: {e}")
+
+    async def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until no update is queued or being processed. Returns False on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -0,0 +1,90 @@
+"""
+Measures how long the bot's modules take to import and checks them against a budget.
+
+Every module is imported in a fresh interpreter with `python -X importtime`, a few times,
+and the fastest run is reported (the others are mostly disk cache noise).
+
+Usage (from the project root):
+    python scripts/importtime.py                      # default modules and budgets
+    python scripts/importtime.py bot --top 20         # show the 20 slowest imports of bot
+    python scripts/importtime.py config=20 utils.encryption=100
+
+Exits with status 1 if any module is over its budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budgets in milliseconds. Modules that CLI scripts and tests import on their own must stay light;
+# bot imports aiogram, whose types alone take seconds, so it is only reported.
+DEFAULT_BUDGETS: Dict[str, Optional[float]] = {
+    "config": 50,
+    "database.supabase_http_client": 150,
+    "database.catalog_cache": 250,
+    "utils.encryption": 150,
+    "utils.catalog_sync": 300,
+    "utils.metrics": 50,
+    "bot": None,
+}
+
+
+def measure(module: str) -> Tuple[float, List[Tuple[float, float, str]]]:
+    """
+    Imports a module in a fresh interpreter.
+    Returns the total import time in ms and (cumulative ms, self ms, name) of every imported module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us) / 1000, int(self_us) / 1000, name.rstrip()))
+    total = next((cumulative for cumulative, _, name in imports if name.strip() == module), 0.0)
+    return total, imports
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check module import times against a budget.")
+    parser.add_argument("modules", nargs="*", help="MODULE or MODULE=BUDGET_MS (default: the built-in list)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module; the fastest one counts.")
+    parser.add_argument("--top", type=int, default=0, help="Also list the N slowest imports of each module.")
+    args = parser.parse_args()
+
+    budgets: Dict[str, Optional[float]] = {}
+    for item in args.modules:
+        module, _, budget = item.partition("=")
+        budgets[module] = float(budget) if budget else DEFAULT_BUDGETS.get(module)
+    budgets = budgets or DEFAULT_BUDGETS
+
+    over_budget = False
+    for module, budget in budgets.items():
+        runs = [measure(module) for _ in range(max(1, args.repeat))]
+        total, imports = min(runs, key=lambda run: run[0])
+
+        status = ""
+        if budget is not None:
+            status = "ok" if total <= budget else "OVER BUDGET"
+            status = f"(budget {budget:.0f} ms) {status}"
+            over_budget |= total > budget
+        print(f"{module:<35} {total:9.1f} ms {status}")
+
+        if args.top:
+            for cumulative, self_ms, name in sorted(imports, reverse=True)[1:args.top + 1]:
+                print(f"    {cumulative:9.1f} ms cumulative {self_ms:9.1f} ms self  {name.strip()}")
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
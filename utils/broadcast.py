@@ -0,0 +1,299 @@
+import asyncio
+import html
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.types import BufferedInputFile
+
+from config import BROADCAST_CHECKPOINT_DIR, BROADCAST_PAGE_SIZE, BROADCAST_CONCURRENCY
+from database.ban_list import ban_list
+from database.supabase_http_client import supabase_http_client
+from middlewares.outbound import send_lane
+from utils.encryption import encryptor
+from utils.executor import blocking_executor
+from utils.watermark import add_watermark_to_workflow, get_watermarked_filename
+
+# How many times a failing page read is retried before the broadcast is paused until the next start
+MAX_PAGE_ATTEMPTS = 5
+# Telegram's limit on a document caption
+CAPTION_LIMIT = 1024
+
+
+@dataclass
+class Broadcast:
+    """
+    A WorkflowUpdate announcement to every buyer of a workflow, with its progress.
+    This is also the checkpoint: it is saved after every page, so a broadcast resumes after a crash.
+    """
+    id: str
+    workflow_id: int
+    workflow_name: str
+    slug: str
+    filepath: str
+    version: str
+    changelog: Optional[str]
+    send_file: bool
+    admin_chat_id: int
+    last_user_id: Optional[int] = None
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    skipped: int = 0
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked + self.skipped
+
+    def throughput(self) -> float:
+        """
+        Recipients processed per second.
+        """
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+
+class BroadcastEngine:
+    """
+    Notifies all buyers of a workflow about an update, optionally with a freshly watermarked file.
+    Buyers are streamed from purchases in pages ordered by user_id (keyset pagination), so only one page
+    is in memory and every buyer is notified once however many times they bought the workflow.
+    Messages go out in the "bulk" lane of the Telegram governor, below purchase deliveries.
+    """
+
+    def __init__(self, checkpoint_dir: str, page_size: int = 500, concurrency: int = 25):
+        """
+        :param checkpoint_dir: Where the progress of running broadcasts is kept.
+        :param page_size: How many purchases are read per request.
+        :param concurrency: How many recipients are being sent to at the same time.
+        """
+        self._checkpoint_dir = checkpoint_dir
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._broadcasts: Dict[str, Broadcast] = {}
+
+    # --- Checkpoints ---
+
+    def _checkpoint_path(self, broadcast_id: str) -> str:
+        return os.path.join(self._checkpoint_dir, f"{broadcast_id}.json")
+
+    def _write_checkpoint(self, data: Dict[str, Any]) -> None:
+        os.makedirs(self._checkpoint_dir, exist_ok=True)
+        path = self._checkpoint_path(data["id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        # Atomic, so a crash never leaves a half-written checkpoint
+        os.replace(tmp_path, path)
+
+    def _read_unfinished(self) -> List[Broadcast]:
+        if not os.path.isdir(self._checkpoint_dir):
+            return []
+        unfinished = []
+        for name in sorted(os.listdir(self._checkpoint_dir)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self._checkpoint_dir, name), encoding="utf-8") as f:
+                broadcast = Broadcast(**json.load(f))
+            if broadcast.finished_at is None:
+                unfinished.append(broadcast)
+        return unfinished
+
+    async def _save(self, broadcast: Broadcast) -> None:
+        await blocking_executor.run_io(self._write_checkpoint, asdict(broadcast))
+
+    # --- Sending ---
+
+    async def _fetch_page(self, broadcast: Broadcast) -> List[Dict[str, Any]]:
+        params = {
+            "workflow_id": f"eq.{broadcast.workflow_id}",
+            "select": "user_id,payment_id",
+            "order": "user_id.asc",
+            "limit": self._page_size,
+        }
+        if broadcast.last_user_id is not None:
+            params["user_id"] = f"gt.{broadcast.last_user_id}"
+        for attempt in range(MAX_PAGE_ATTEMPTS):
+            try:
+                return await supabase_http_client.select("purchases", params=params, raise_errors=True)
+            except Exception as e:
+                if attempt == MAX_PAGE_ATTEMPTS - 1:
+                    raise
+                logging.warning(f"Broadcast {broadcast.id} could not read purchases, retrying: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _fetch_usernames(self, user_ids: List[int]) -> Dict[int, str]:
+        if not user_ids:
+            return {}
+        rows = await supabase_http_client.select("users", params={
+            "telegram_id": f"in.({','.join(str(user_id) for user_id in user_ids)})",
+            "select": "telegram_id,username",
+        })
+        return {int(row["telegram_id"]): row["username"] for row in rows or [] if row.get("username")}
+
+    def _update_text(self, broadcast: Broadcast) -> str:
+        # The changelog is the admin's message as HTML already; the name and version are plain text
+        name = html.escape(broadcast.workflow_name, quote=False)
+        version = html.escape(broadcast.version, quote=False)
+        text = f"🔄 Вышло обновление workflow <b>{name}</b> до версии {version}!"
+        if broadcast.changelog:
+            text += f"\n\n<b>Что нового:</b>\n{broadcast.changelog}"
+        return text
+
+    async def _send_one(self, bot: Bot, broadcast: Broadcast, user_id: int, payment_id: str, username: str) -> None:
+        if await ban_list.is_banned(user_id):
+            broadcast.skipped += 1
+            return
+        try:
+            if broadcast.send_file:
+                charge_id = await encryptor.decrypt_async(payment_id)
+                data = await blocking_executor.run_cpu(
+                    add_watermark_to_workflow,
+                    original_filepath=broadcast.filepath,
+                    user_id=user_id, username=username,
+                    payment_id=charge_id,
+                    workflow_version=broadcast.version
+                )
+                if not data:
+                    raise Exception("Watermarked file creation failed.")
+                text = self._update_text(broadcast)
+                if len(text) > CAPTION_LIMIT:
+                    # A long changelog does not fit into a caption, so it goes as a message of its own
+                    await bot.send_message(chat_id=user_id, text=text)
+                    text = None
+                await bot.send_document(
+                    chat_id=user_id,
+                    document=BufferedInputFile(data, filename=get_watermarked_filename(user_id, broadcast.slug)),
+                    caption=text
+                )
+            else:
+                await bot.send_message(chat_id=user_id, text=self._update_text(broadcast))
+            broadcast.sent += 1
+        except TelegramForbiddenError:
+            # The user blocked the bot
+            broadcast.blocked += 1
+        except Exception as e:
+            broadcast.failed += 1
+            logging.error(f"Broadcast {broadcast.id} failed for user {user_id}: {e}")
+
+    async def _run(self, bot: Bot, broadcast: Broadcast) -> None:
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def send(user_id: int, payment_id: str, username: str) -> None:
+            async with semaphore:
+                await self._send_one(bot, broadcast, user_id, payment_id, username)
+
+        logging.info(f"Broadcast {broadcast.id} started (resuming after user {broadcast.last_user_id}).")
+        with send_lane("bulk"):
+            while True:
+                rows = await self._fetch_page(broadcast)
+                if not rows:
+                    break
+                # A buyer with several purchases is notified once; any of the purchases will do
+                recipients: Dict[int, str] = {}
+                for row in rows:
+                    recipients.setdefault(int(row["user_id"]), row["payment_id"])
+                usernames = await self._fetch_usernames(list(recipients)) if broadcast.send_file else {}
+
+                await asyncio.gather(*(
+                    send(user_id, payment_id, usernames.get(user_id, "user"))
+                    for user_id, payment_id in recipients.items()
+                ))
+                broadcast.last_user_id = int(rows[-1]["user_id"])
+                await self._save(broadcast)
+                logging.info(
+                    f"Broadcast {broadcast.id}: {broadcast.processed} processed, "
+                    f"{broadcast.throughput():.1f} recipients/s."
+                )
+                if len(rows) < self._page_size:
+                    break
+
+        broadcast.finished_at = time.time()
+        await self._save(broadcast)
+        logging.info(f"Broadcast {broadcast.id} finished: {self.report(broadcast)}")
+        await bot.send_message(broadcast.admin_chat_id, f"✅ Рассылка завершена.\n{self.report(broadcast)}")
+
+    async def _run_safely(self, bot: Bot, broadcast: Broadcast) -> None:
+        try:
+            await self._run(bot, broadcast)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The checkpoint stays unfinished, so the broadcast resumes on the next start
+            logging.error(f"Broadcast {broadcast.id} stopped: {e}", exc_info=True)
+            try:
+                await bot.send_message(
+                    broadcast.admin_chat_id,
+                    f"❌ Рассылка приостановлена из-за ошибки и продолжится после перезапуска бота.\n{self.report(broadcast)}"
+                )
+            except Exception as notify_error:
+                logging.error(f"Could not notify the admin about broadcast {broadcast.id}: {notify_error}")
+        finally:
+            self._tasks.pop(broadcast.id, None)
+
+    @staticmethod
+    def report(broadcast: Broadcast) -> str:
+        return (
+            f"Отправлено: {broadcast.sent}, ошибок: {broadcast.failed}, "
+            f"заблокировали бота: {broadcast.blocked}, пропущено: {broadcast.skipped}, "
+            f"скорость: {broadcast.throughput():.1f}/с"
+        )
+
+    # --- Public API ---
+
+    async def start(self, bot: Bot, broadcast: Broadcast) -> bool:
+        """
+        Starts a broadcast in the background. Returns False if the same one is already running.
+        """
+        if broadcast.id in self._tasks:
+            return False
+        await self._save(broadcast)
+        self._broadcasts[broadcast.id] = broadcast
+        self._tasks[broadcast.id] = asyncio.create_task(self._run_safely(bot, broadcast))
+        return True
+
+    async def resume_pending(self, bot: Bot) -> None:
+        """
+        Restarts broadcasts interrupted by a shutdown or a crash from their last checkpoint.
+        """
+        for broadcast in await blocking_executor.run_io(self._read_unfinished):
+            logging.info(f"Resuming broadcast {broadcast.id}.")
+            await self.start(bot, broadcast)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            broadcast_id: {
+                "running": broadcast_id in self._tasks,
+                "sent": broadcast.sent,
+                "failed": broadcast.failed,
+                "blocked": broadcast.blocked,
+                "skipped": broadcast.skipped,
+                "throughput": broadcast.throughput(),
+            }
+            for broadcast_id, broadcast in self._broadcasts.items()
+        }
+
+    async def stop(self) -> None:
+        """
+        Stops running broadcasts; they resume from their checkpoints on the next start.
+        """
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Initialize the broadcast engine instance for global use
+broadcaster = BroadcastEngine(
+    checkpoint_dir=BROADCAST_CHECKPOINT_DIR,
+    page_size=BROADCAST_PAGE_SIZE,
+    concurrency=BROADCAST_CONCURRENCY,
+)
@@ -0,0 +1,98 @@
+import html
+import logging
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+from cachetools import LRUCache
+
+from config import CARD_CACHE_SIZE
+from database.models import Workflow
+from keyboards.inline import get_workflow_card_keyboard
+from utils.metrics import cache_requests
+
+
+@dataclass(frozen=True)
+class RenderedView:
+    """
+    A message ready to be sent: HTML text and its keyboard.
+    """
+    text: str
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+
+
+def render_workflow_card(workflow: Workflow, price: float) -> RenderedView:
+    """
+    Formats the details card of a workflow. The only place the card layout is defined.
+    Values are escaped, so the text matches Message.html_text of the sent card.
+    """
+    card_text = (
+        f"📄 <b>{html.escape(workflow.name, quote=False)}</b>\n\n"
+        f"<b>Описание:</b> {html.escape(workflow.description or '', quote=False)}\n\n"
+        f"<b>Версия:</b> {html.escape(workflow.version, quote=False)}\n"
+        f"<b>Цена:</b> {price:.0f}₽"
+    )
+    return RenderedView(text=card_text, reply_markup=get_workflow_card_keyboard(workflow.slug, price))
+
+
+class CardCache:
+    """
+    Pre-rendered workflow cards keyed on (slug, version, price).
+    The cache is dropped whenever the catalog version changes (a reload or an invalidation),
+    so edited descriptions show up without a version bump; warm() renders the whole catalog up front.
+    """
+
+    def __init__(self, maxsize: int):
+        self._cards = LRUCache(maxsize=maxsize)
+        self._catalog_version: Optional[int] = None
+
+    def _sync(self, catalog_version: int) -> None:
+        if catalog_version != self._catalog_version:
+            self._cards.clear()
+            self._catalog_version = catalog_version
+
+    def get(self, workflow: Workflow, price: float, catalog_version: int) -> RenderedView:
+        """
+        Returns the card of a workflow at a price, rendering it only on the first view.
+        """
+        self._sync(catalog_version)
+        key = (workflow.slug, workflow.version, price)
+        view = self._cards.get(key)
+        cache_requests.inc("cards", "miss" if view is None else "hit")
+        if view is None:
+            view = self._cards[key] = render_workflow_card(workflow, price)
+        return view
+
+    def warm(self, workflows: Iterable[Workflow], price: float, catalog_version: int) -> int:
+        """
+        Renders the cards of all given workflows at a price. Returns the number of cards rendered.
+        """
+        self._sync(catalog_version)
+        count = 0
+        for workflow in workflows:
+            key = (workflow.slug, workflow.version, price)
+            if key not in self._cards:
+                self._cards[key] = render_workflow_card(workflow, price)
+            count += 1
+        return count
+
+
+async def edit_view(message: Message, view: RenderedView) -> bool:
+    """
+    Shows a view in an existing message.
+    Nothing is sent when the message already shows exactly this content. Returns True if the message was edited.
+    """
+    if message.html_text == view.text and message.reply_markup == view.reply_markup:
+        return False
+    try:
+        await message.edit_text(text=view.text, reply_markup=view.reply_markup)
+        return True
+    except TelegramBadRequest as e:
+        # Formatting can make the comparison above miss an identical message
+        logging.warning(f"Could not edit message {message.message_id}: {e}")
+        return False
+
+
+# Initialize the card cache instance for global use
+card_cache = CardCache(maxsize=CARD_CACHE_SIZE)
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from config import WORKFLOWS_DIR, CATALOG_SYNC_INDEX_PATH
+from database.catalog_cache import catalog_cache
+from database.resilience import SupabaseError
+from database.supabase_http_client import supabase_http_client
+from utils.executor import blocking_executor
+from utils.watermark import prime_watermark_template
+
+# Optional sidecar with shop metadata: workflows/foo.json -> workflows/foo.meta.json
+META_SUFFIX = ".meta.json"
+META_FIELDS = {"slug", "name", "description", "category", "priority", "price", "version", "is_active"}
+HASH_CHUNK_SIZE = 1024 * 1024
+# Slugs per existence check, so the query string stays short
+SLUG_QUERY_BATCH = 100
+
+
+class InvalidWorkflowFile(Exception):
+    pass
+
+
+@dataclass
+class SyncResult:
+    changed: List[Dict[str, Any]] = field(default_factory=list)  # Rows to upsert into workflows
+    removed: List[str] = field(default_factory=list)  # Slugs whose files are gone
+    invalid: Dict[str, str] = field(default_factory=dict)  # Relative path -> error
+    unchanged: int = 0
+    index: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # Version for a changed workflow without a sidecar version, used only if it is not in the table yet
+    new_versions: Dict[str, str] = field(default_factory=dict)
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.changed)} changed, {self.unchanged} unchanged, "
+            f"{len(self.removed)} removed, {len(self.invalid)} invalid"
+        )
+
+
+def _hash_file(path: str) -> str:
+    # Read in chunks, so a large file is hashed without being loaded into memory
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_json(path: str) -> Any:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise InvalidWorkflowFile(f"cannot read {os.path.basename(path)}: {e}") from e
+
+
+def validate_workflow(data: Any) -> None:
+    """
+    Checks that a parsed file looks like an n8n workflow export.
+    """
+    if not isinstance(data, dict):
+        raise InvalidWorkflowFile("the top level is not a JSON object")
+    if not isinstance(data.get("nodes"), list) or not data["nodes"]:
+        raise InvalidWorkflowFile("'nodes' must be a non-empty list")
+    if not isinstance(data.get("connections"), dict):
+        raise InvalidWorkflowFile("'connections' must be an object")
+
+
+def validate_meta(meta: Any) -> None:
+    if not isinstance(meta, dict):
+        raise InvalidWorkflowFile("the metadata file is not a JSON object")
+    unknown = set(meta) - META_FIELDS
+    if unknown:
+        raise InvalidWorkflowFile(f"unknown metadata fields: {', '.join(sorted(unknown))}")
+    if "priority" in meta and not isinstance(meta["priority"], int):
+        raise InvalidWorkflowFile("'priority' must be an integer")
+    if "price" in meta and not isinstance(meta["price"], (int, float)):
+        raise InvalidWorkflowFile("'price' must be a number")
+
+
+class CatalogSync:
+    """
+    Keeps the workflows table in step with the JSON files in WORKFLOWS_DIR.
+    A local index remembers the mtime, size and SHA-256 of every file, so a run only hashes files whose
+    mtime or size moved and only parses files whose content actually changed. Changed files are
+    validated, upserted into workflows (on slug) in bulk and their watermark templates are cached;
+    workflows whose file disappeared are deactivated.
+
+    A file's slug defaults to its name; an optional <name>.meta.json next to it can set slug, name,
+    description, category, priority, price, version and is_active. A synced file is active unless its
+    sidecar says otherwise, so a file that comes back reactivates its workflow. Other columns not set
+    by the sidecar are left untouched: that includes the version (set by admins when they announce an
+    update), which only defaults to a prefix of the file's hash for a workflow not in the table yet.
+    A slug changed in the sidecar deactivates the old one.
+    """
+
+    def __init__(self, workflows_dir: str, index_path: str):
+        self._workflows_dir = workflows_dir
+        self._index_path = index_path
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning(f"Catalog sync index is corrupt, rescanning everything: {e}")
+            return {}
+
+    def _save_index(self, index: Dict[str, Dict[str, Any]]) -> None:
+        os.makedirs(os.path.dirname(self._index_path) or ".", exist_ok=True)
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._index_path)
+
+    def _list_files(self) -> List[str]:
+        paths = []
+        for root, _, files in os.walk(self._workflows_dir):
+            for name in files:
+                if name.endswith(".json") and not name.endswith(META_SUFFIX):
+                    paths.append(os.path.join(root, name))
+        return sorted(paths)
+
+    def _scan_file(self, path: str, entry: Optional[Dict[str, Any]], result: SyncResult) -> Dict[str, Any]:
+        stat = os.stat(path)
+        meta_path = path[:-len(".json")] + META_SUFFIX
+        meta_stat = os.stat(meta_path) if os.path.exists(meta_path) else None
+        fingerprint = {
+            "filepath": path,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "meta_mtime_ns": meta_stat.st_mtime_ns if meta_stat else None,
+            "meta_size": meta_stat.st_size if meta_stat else None,
+        }
+        if entry and all(entry.get(key) == value for key, value in fingerprint.items()):
+            result.unchanged += 1
+            return entry
+
+        sha256 = _hash_file(path)
+        meta_sha256 = _hash_file(meta_path) if meta_stat else None
+        if entry and entry.get("sha256") == sha256 and entry.get("meta_sha256") == meta_sha256 \
+                and entry.get("filepath") == path:
+            # Touched but not modified (e.g. a redeploy): just remember the new mtime
+            result.unchanged += 1
+            return {**entry, **fingerprint}
+
+        data = _load_json(path)
+        validate_workflow(data)
+        meta = {}
+        if meta_stat:
+            meta = _load_json(meta_path)
+            validate_meta(meta)
+
+        slug = meta.get("slug") or os.path.splitext(os.path.basename(path))[0]
+        row = {"is_active": True, **meta, "slug": slug, "filepath": path}
+        row["name"] = meta.get("name") or data.get("name") or slug
+        if meta.get("version"):
+            row["version"] = str(meta["version"])
+            # The file is already parsed, so the first purchase will not have to parse it again
+            prime_watermark_template(path, row["version"], data, stat.st_mtime_ns, stat.st_size)
+        else:
+            result.new_versions[slug] = sha256[:12]
+        result.changed.append(row)
+        return {**fingerprint, "sha256": sha256, "meta_sha256": meta_sha256, "slug": slug}
+
+    def scan(self) -> SyncResult:
+        """
+        Compares WORKFLOWS_DIR with the index. Blocking file I/O; run it off the event loop.
+        """
+        result = SyncResult()
+        old_index = self._load_index()
+        if not os.path.isdir(self._workflows_dir):
+            logging.warning(f"Workflows directory {self._workflows_dir} does not exist, nothing to sync.")
+            result.index = old_index
+            return result
+
+        slugs = set()
+        for path in self._list_files():
+            relpath = os.path.relpath(path, self._workflows_dir)
+            entry = old_index.get(relpath)
+            try:
+                new_entry = self._scan_file(path, entry, result)
+                if new_entry["slug"] in slugs:
+                    raise InvalidWorkflowFile(f"duplicate slug '{new_entry['slug']}'")
+            except (InvalidWorkflowFile, OSError) as e:
+                result.invalid[relpath] = str(e)
+                if result.changed and result.changed[-1]["filepath"] == path:
+                    result.changed.pop()
+                # Keep the previous state, so the file is checked again on the next run
+                if entry:
+                    result.index[relpath] = entry
+                    slugs.add(entry["slug"])
+                continue
+            slugs.add(new_entry["slug"])
+            result.index[relpath] = new_entry
+
+        removed = set()
+        for relpath, entry in old_index.items():
+            new_entry = result.index.get(relpath)
+            # Gone, or renamed through its sidecar
+            if new_entry is None or new_entry["slug"] != entry["slug"]:
+                removed.add(entry["slug"])
+        # A slug that moved to another file is still there
+        result.removed = sorted(removed - slugs)
+        return result
+
+    @staticmethod
+    async def _existing_slugs(slugs: List[str]) -> set:
+        existing = set()
+        for start in range(0, len(slugs), SLUG_QUERY_BATCH):
+            batch = slugs[start:start + SLUG_QUERY_BATCH]
+            quoted = ",".join('"' + slug.replace('"', '\\"') + '"' for slug in batch)
+            rows = await supabase_http_client.select(
+                "workflows", params={"slug": f"in.({quoted})", "select": "slug"}, raise_errors=True
+            )
+            existing.update(row["slug"] for row in rows)
+        return existing
+
+    async def sync(self, dry_run: bool = False) -> SyncResult:
+        """
+        Scans WORKFLOWS_DIR and pushes the changes to the workflows table.
+        The index is only saved once the database accepted the changes, so a failed run is retried in full.
+        """
+        result = await blocking_executor.run_io(self.scan)
+        for relpath, error in result.invalid.items():
+            logging.error(f"Catalog sync: skipping invalid workflow file {relpath}: {error}")
+        if dry_run:
+            logging.info(f"Catalog sync (dry run): {result.summary()}.")
+            return result
+
+        # Workflows already in the table keep their version; new ones need one
+        unversioned = [row["slug"] for row in result.changed if "version" not in row]
+        if unversioned:
+            try:
+                existing = await self._existing_slugs(unversioned)
+            except SupabaseError as e:
+                logging.error(f"Catalog sync: could not read the existing workflows, the index is left as it was: {e}")
+                return result
+            for row in result.changed:
+                if "version" not in row and row["slug"] not in existing:
+                    row["version"] = result.new_versions[row["slug"]]
+
+        # A bulk upsert needs the same columns in every row, so rows are grouped by their columns
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
+        for row in result.changed:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for rows in groups.values():
+            if not await supabase_http_client.upsert("workflows", rows, on_conflict="slug"):
+                logging.error("Catalog sync: the workflows upsert failed, the index is left as it was.")
+                return result
+
+        for slug in result.removed:
+            if await supabase_http_client.update("workflows", match={"slug": slug}, new_data={"is_active": False}) is None:
+                logging.error(f"Catalog sync: deactivating '{slug}' failed, the index is left as it was.")
+                # The upserts and earlier deactivations went through, so the catalog has to pick them up
+                await catalog_cache.invalidate_everywhere()
+                return result
+            logging.info(f"Catalog sync: deactivated workflow '{slug}', its file was removed.")
+
+        await blocking_executor.run_io(self._save_index, result.index)
+        if result.changed or result.removed:
+            await catalog_cache.invalidate_everywhere()
+        logging.info(f"Catalog sync finished: {result.summary()}.")
+        return result
+
+
+# Initialize the catalog sync instance for global use
+catalog_sync = CatalogSync(workflows_dir=WORKFLOWS_DIR, index_path=CATALOG_SYNC_INDEX_PATH)
+
+
+async def _main(dry_run: bool) -> int:
+    await supabase_http_client.start()
+    try:
+        result = await catalog_sync.sync(dry_run=dry_run)
+    finally:
+        await supabase_http_client.close()
+        blocking_executor.shutdown()
+    print(result.summary())
+    return 1 if result.invalid else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the workflows table with the files in WORKFLOWS_DIR.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    raise SystemExit(asyncio.run(_main(args.dry_run)))
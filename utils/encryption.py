@@ -1,17 +1,30 @@
-from cryptography.fernet import Fernet
 import os
 from config import ENCRYPTION_KEY # We need to add this to config.py
+from utils.executor import blocking_executor
 
 class Encryptor:
     """
     A simple wrapper around Fernet symmetric encryption.
     It expects the encryption key to be set as an environment variable.
+    The cipher (and the cryptography package) is only loaded on first use; call ensure_ready()
+    at startup to fail fast on a missing or malformed key.
     """
     def __init__(self, key: str):
-        if not key:
-            raise ValueError("ENCRYPTION_KEY must be set in the environment.")
-        self.key = key.encode()
-        self.fernet = Fernet(self.key)
+        self.key = key.encode() if key else None
+        self._fernet = None
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            if not self.key:
+                raise ValueError("ENCRYPTION_KEY must be set in the environment.")
+            from cryptography.fernet import Fernet
+            self._fernet = Fernet(self.key)
+        return self._fernet
+
+    def ensure_ready(self) -> None:
+        """Validates the key by building the cipher."""
+        self.fernet
 
     def encrypt(self, data: str) -> str:
         """Encrypts a string."""
@@ -27,5 +40,13 @@ class Encryptor:
         decrypted_data = self.fernet.decrypt(encrypted_data.encode())
         return decrypted_data.decode()
 
-# Initialize a global encryptor instance
+    async def encrypt_async(self, data: str) -> str:
+        """Encrypts a string without blocking the event loop."""
+        return await blocking_executor.run_io(self.encrypt, data)
+
+    async def decrypt_async(self, encrypted_data: str) -> str:
+        """Decrypts a string without blocking the event loop."""
+        return await blocking_executor.run_io(self.decrypt, encrypted_data)
+
+# Initialize a global encryptor instance (the cipher is built on first use)
 encryptor = Encryptor(key=ENCRYPTION_KEY)
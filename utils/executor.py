@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from config import EXECUTOR_MAX_THREADS, EXECUTOR_MAX_CONCURRENCY, EXECUTOR_PROCESS_POOL, EXECUTOR_MAX_PROCESSES
+
+T = TypeVar("T")
+
+
+def _initialize_process(initializer: Optional[Callable[..., Any]], args: tuple) -> None:
+    # Runs in every worker process; an exception here would break the whole pool
+    if initializer is None:
+        return
+    try:
+        initializer(*args)
+    except Exception as e:
+        logging.error(f"Worker process initializer {getattr(initializer, '__name__', initializer)} failed: {e}")
+
+
+class BlockingExecutor:
+    """
+    Runs blocking work (file I/O, JSON processing, encryption) off the event loop.
+    I/O-bound calls go to a thread pool; CPU-heavy calls can optionally go to a process pool.
+    Worker processes do not share the main process's caches; start_process_pool() can fill theirs.
+    A semaphore caps how many calls run at once so a burst of deliveries queues here instead of
+    exhausting the pools, and simple counters expose the queue depth.
+    """
+
+    def __init__(self, max_threads: int, max_concurrency: int, use_process_pool: bool = False, max_processes: int = 2):
+        self._max_threads = max_threads
+        self._max_concurrency = max_concurrency
+        self._use_process_pool = use_process_pool
+        self._max_processes = max_processes
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Metrics
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self._max_threads, thread_name_prefix="blocking")
+        return self._thread_pool
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self._max_processes)
+        return self._process_pool
+
+    async def start_process_pool(self, initializer: Optional[Callable[..., Any]] = None, *args: Any) -> None:
+        """
+        Starts the worker processes now instead of on the first CPU call, running initializer(*args)
+        in each of them first (e.g. to fill a cache). Does nothing if the process pool is disabled
+        or already running. The initializer and its arguments must be picklable.
+        """
+        if not self._use_process_pool or self._process_pool is not None:
+            return
+        self._process_pool = ProcessPoolExecutor(
+            max_workers=self._max_processes, initializer=_initialize_process, initargs=(initializer, args)
+        )
+        # Processes start with the first tasks; waiting for them keeps the initializer off the delivery path
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._process_pool, os.getpid) for _ in range(self._max_processes)))
+
+    async def _run(self, pool: Executor, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            # Leaves the queue whether a slot was acquired or the caller was cancelled while waiting
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, partial(fn, *args, **kwargs))
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+        self.completed += 1
+        return result
+
+    async def run_io(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Runs a blocking I/O call in the thread pool.
+        """
+        return await self._run(self._get_thread_pool(), fn, *args, **kwargs)
+
+    async def run_cpu(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Runs a CPU-heavy call in the process pool if it is enabled, otherwise in the thread pool.
+        The function and its arguments must be picklable when the process pool is used.
+        """
+        pool = self._get_process_pool() if self._use_process_pool else self._get_thread_pool()
+        return await self._run(pool, fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the current queue depth and call counters.
+        """
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def shutdown(self) -> None:
+        """
+        Shuts the pools down, waiting for calls that are already running.
+        """
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        self._thread_pool = None
+        self._process_pool = None
+        logging.info("Blocking executor shut down.")
+
+
+# Initialize the executor instance for global use
+blocking_executor = BlockingExecutor(
+    max_threads=EXECUTOR_MAX_THREADS,
+    max_concurrency=EXECUTOR_MAX_CONCURRENCY,
+    use_process_pool=EXECUTOR_PROCESS_POOL,
+    max_processes=EXECUTOR_MAX_PROCESSES,
+)
@@ -0,0 +1,506 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from aiogram import Bot
+from aiogram.exceptions import ClientDecodeError, TelegramNetworkError, TelegramServerError
+from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import (
+    PRIVATE_CHANNEL_ID, KEEP_WATERMARKED_FILES, FULFILLMENT_QUEUE_PATH, FULFILLMENT_WORKERS,
+    FULFILLMENT_STEP_ATTEMPTS, FULFILLMENT_MAX_ATTEMPTS, FULFILLMENT_RETRY_DELAY, FULFILLMENT_DRAIN_TIMEOUT,
+)
+from database.catalog_cache import get_workflow_by_slug
+from database.idempotency import payment_deduplicator
+from database.job_queue import Job, JobQueue
+from database.models import DeliveryLog
+from database.resilience import CONNECT_ERRORS, RetryPolicy, SupabaseError
+from database.supabase_http_client import supabase_http_client
+from database.write_behind import write_behind
+from utils.encryption import encryptor
+from utils.executor import blocking_executor
+from utils.invite_pool import invite_pool
+from middlewares.outbound import track_sends
+from utils.metrics import metrics
+from utils.pricing import price_service, PRICE_EARLY_BIRD
+from utils.watermark import add_watermark_to_workflow, get_watermarked_filename, save_watermarked_file
+
+JOB_KIND = "purchase"
+
+STEP_SECONDS = metrics.histogram(
+    "fulfillment_step_duration_seconds", "Duration of each fulfillment step attempt.", ("step", "status")
+)
+# From the successful payment to the end of the last step, retries and restarts included
+FULFILLMENT_SECONDS = metrics.histogram(
+    "fulfillment_duration_seconds", "Time from payment to completed fulfillment.",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, 3600.0),
+)
+
+
+class StepFailed(Exception):
+    """
+    Raised by a step that failed in a way retrying cannot fix.
+    """
+
+
+class DuplicatePurchase(Exception):
+    """
+    Raised when the charge was already recorded by another process; that process delivers it.
+    """
+
+
+class OutcomeUnknown(Exception):
+    """
+    Raised when a step that must not run twice failed in a way that does not tell whether it took effect.
+    """
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    One stage of a fulfillment.
+    Only idempotent steps are retried blindly. Any other step is retried only after a failure that shows
+    it did not take effect; when its outcome is unknown it is never run again: it is skipped, or the
+    job is handed to support if the step is required.
+    A step whose only side effects are Telegram calls (telegram_only) is known to have had no effect
+    when it is cancelled before any call went out, e.g. while waiting for the outbound governor.
+    """
+    name: str
+    run: Callable[[Job], Awaitable[None]]
+    idempotent: bool
+    required: bool = False
+    telegram_only: bool = False
+
+
+def outcome_unknown(error: BaseException) -> bool:
+    """
+    Tells whether a failed call may still have taken effect: the request went out but no clear answer came back.
+    """
+    if isinstance(error, (TelegramNetworkError, TelegramServerError, ClientDecodeError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, SupabaseError):
+        cause = error.__cause__
+        if cause is None or isinstance(cause, CONNECT_ERRORS):
+            # Rejected by the open circuit, or never reached the server
+            return False
+        if isinstance(cause, httpx.HTTPStatusError):
+            # A 5xx may come from a proxy that gave up while the database carried on
+            return cause.response.status_code >= 500
+        return True
+    return False
+
+
+def log_delivery(user_id: int, workflow_id: int, status: str, error_message: str | None = None):
+    """
+    Queues a DeliveryLog row; delivery logs are written in bulk by the write-behind queue.
+    """
+    delivery_log = DeliveryLog(user_id=user_id, workflow_id=workflow_id, status=status, error_message=error_message)
+    write_behind.insert("delivery_logs", {
+        "user_id": delivery_log.user_id,
+        "workflow_id": delivery_log.workflow_id,
+        "status": delivery_log.status,
+        "error_message": delivery_log.error_message,
+        "delivered_at": delivery_log.delivered_at.isoformat(),
+    })
+
+
+async def save_audit_copy(filename: str, data: bytes):
+    """
+    Writes an audit copy of a delivered file without blocking the event loop.
+    """
+    try:
+        await blocking_executor.run_io(save_watermarked_file, filename, data)
+    except Exception as e:
+        logging.error(f"Failed to save audit copy {filename}: {e}")
+
+
+class StepStats:
+    """
+    Latency and outcome counters of one fulfillment step.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds: float, ok: bool) -> None:
+        self.count += 1
+        if not ok:
+            self.failed += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "failed": self.failed,
+            "avg_seconds": self.total_seconds / self.count if self.count else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class FulfillmentService:
+    """
+    Delivers paid purchases outside of the payment handler.
+    The handler only enqueues a job into a durable local queue and acknowledges the payment;
+    a pool of workers then runs the steps (save the purchase, count the Early Bird sale, watermark
+    and send the file, send the invite link, confirm), starting with looking up the workflow, so the
+    handler does not depend on Supabase at all. Finished steps are persisted, so a retry
+    or a restart resumes at the step that failed instead of repeating the ones that succeeded.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        workers: int = 4,
+        step_attempts: int = 3,
+        max_attempts: int = 5,
+        retry_delay: float = 30.0,
+        drain_timeout: float = 20.0,
+    ):
+        """
+        :param queue: The durable queue the jobs are stored in.
+        :param workers: Number of jobs processed at the same time.
+        :param step_attempts: How many times a step is tried within one run of a job.
+        :param max_attempts: How many runs a job gets before it is given up.
+        :param retry_delay: Delay before the second run of a job, doubled on every further run.
+        :param drain_timeout: How long stop() lets running jobs finish before cancelling them.
+        """
+        self._queue = queue
+        self._workers = workers
+        self._step_retry = RetryPolicy(max_attempts=step_attempts, base_delay=0.5, max_delay=5.0)
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._drain_timeout = drain_timeout
+        self._stopping = False
+        self._bot: Optional[Bot] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._background_tasks = set()
+        # Jobs left 'running' because the queue could not be updated after an error; handed back once it works
+        self._stranded: List[Job] = []
+        self._steps: List[Step] = [
+            # Only reads, and stores what it found in the job
+            Step("resolve_workflow", self._resolve_workflow, idempotent=True),
+            # An upsert on payment_hash: repeating it cannot create a second purchase
+            Step("save_purchase", self._save_purchase, idempotent=True),
+            # An RPC increment and Telegram sends happen again if repeated
+            Step("early_bird", self._count_early_bird, idempotent=False),
+            Step("deliver_file", self._deliver_file, idempotent=False, required=True, telegram_only=True),
+            Step("invite_link", self._send_invite_link, idempotent=False, telegram_only=True),
+            Step("confirm", self._send_confirmation, idempotent=False, telegram_only=True),
+        ]
+
+        # Metrics
+        self.step_stats: Dict[str, StepStats] = {step.name: StepStats() for step in self._steps}
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    async def enqueue(self, payment_hash: str, payload: Dict[str, Any]) -> bool:
+        """
+        Durably records a purchase to fulfill. Returns False if it was already queued.
+        """
+        created = await self._queue.enqueue(JOB_KIND, payment_hash, payload)
+        self._wakeup.set()
+        return created
+
+    async def depth(self) -> int:
+        """
+        Returns the number of purchases waiting for or in fulfillment.
+        """
+        return await self._queue.depth(JOB_KIND)
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": await self.depth(),
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "steps": {name: stats.as_dict() for name, stats in self.step_stats.items()},
+        }
+
+    # --- Steps ---
+
+    async def _resolve_workflow(self, job: Job) -> None:
+        p = job.payload
+        if "workflow_id" in p:
+            return
+        # An outage raises and the job is retried; only a workflow that really is gone fails it
+        workflow = await get_workflow_by_slug(p["slug"], raise_errors=True)
+        if not workflow:
+            raise StepFailed(f"Workflow '{p['slug']}' not found after a successful payment.")
+        p.update(workflow_id=workflow.id, filepath=workflow.filepath, version=workflow.version)
+        await self._queue.save_payload(job)
+
+    async def _save_purchase(self, job: Job) -> None:
+        p = job.payload
+        purchase_data = {
+            "user_id": p["user_id"], "workflow_id": p["workflow_id"],
+            "price": p["price"],
+            "payment_id": p["payment_id"],
+            "payment_hash": job.key,
+            "email": p["email"],
+        }
+        # Keyed on payment_hash, so a retry after a lost response does not create a second purchase;
+        # a failed write raises instead of passing for a saved purchase
+        if not await payment_deduplicator.record_purchase(purchase_data):
+            raise DuplicatePurchase(f"Payment {job.key[:12]} was already recorded by another process.")
+        logging.info(f"Purchase by user {p['user_id']} for workflow {p['workflow_id']} saved to DB.")
+
+    async def _count_early_bird(self, job: Job) -> None:
+        if job.payload["price"] != PRICE_EARLY_BIRD:
+            return
+        await supabase_http_client.rpc(
+            'increment_setting_value', params={'setting_key': 'early_bird_counter', 'increment_value': 1}, raise_errors=True
+        )
+        await price_service.record_early_bird_sale()
+        logging.info("Incremented early_bird_counter.")
+
+    async def _deliver_file(self, job: Job) -> None:
+        p = job.payload
+        try:
+            payment_id = await encryptor.decrypt_async(p["payment_id"])
+            # Reading and watermarking a large workflow must not stall other users' updates
+            watermarked_data = await blocking_executor.run_cpu(
+                add_watermark_to_workflow,
+                original_filepath=p["filepath"],
+                user_id=p["user_id"], username=p["username"],
+                payment_id=payment_id,
+                workflow_version=p["version"]
+            )
+            if not watermarked_data:
+                raise StepFailed("Watermarked file creation failed.")
+
+            # The file is sent straight from memory, nothing touches the disk on the hot path
+            watermarked_filename = get_watermarked_filename(p["user_id"], p["slug"])
+            await self._bot.send_document(
+                chat_id=p["user_id"],
+                document=BufferedInputFile(watermarked_data, filename=watermarked_filename),
+                caption="✅ Ваш workflow готов! Спасибо за использование нашего сервиса."
+            )
+            logging.info(f"Successfully sent watermarked file to user {p['user_id']}")
+        except Exception as e:
+            log_delivery(p["user_id"], p["workflow_id"], "failed", error_message=str(e))
+            raise
+
+        if KEEP_WATERMARKED_FILES:
+            # Keep an audit copy, written off the event loop
+            task = asyncio.create_task(save_audit_copy(watermarked_filename, watermarked_data))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+        log_delivery(p["user_id"], p["workflow_id"], "success")
+        write_behind.increment('increment_workflow_downloads', {'workflow_id': p["workflow_id"]})
+
+    async def _send_invite_link(self, job: Job) -> None:
+        user_id = job.payload["user_id"]
+        if not PRIVATE_CHANNEL_ID:
+            logging.warning("PRIVATE_CHANNEL_ID is not set. Skipping invite link generation.")
+            return
+        try:
+            invite_link, expires_at = await invite_pool.get(job.payload["workflow_id"])
+        except Exception as e:
+            # The bonus must not hold up the purchase, so the user is told and the job moves on
+            logging.error(f"Failed to create invite link for user {user_id}: {e}")
+            await self._bot.send_message(user_id, "Не удалось создать пригласительную ссылку в приватный канал. Если проблема повторится, пожалуйста, обратитесь в поддержку.")
+            return
+        hours_left = max(1, int((expires_at - datetime.now()).total_seconds() // 3600))
+        await self._bot.send_message(
+            chat_id=user_id,
+            text=f"🎁 В качестве бонуса, вот ваше персональное приглашение в наш приватный канал. Ссылка действует еще {hours_left} ч.:\n{invite_link}"
+        )
+        logging.info(f"Sent invite link to user {user_id}")
+
+    async def _send_confirmation(self, job: Job) -> None:
+        # Final confirmation message with a button
+        await self._bot.send_message(
+            chat_id=job.payload["user_id"],
+            text="Все готово! Если у вас возникнут вопросы, обращайтесь в поддержку.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="🏠 На главную", callback_data="main_menu"),
+                    InlineKeyboardButton(text="💬 Поддержка", callback_data="support_menu")
+                ]
+            ])
+        )
+
+    # --- Workers ---
+
+    async def _run_step(self, step: Step, job: Job) -> None:
+        for attempt in range(self._step_retry.max_attempts):
+            started = time.perf_counter()
+            try:
+                await step.run(job)
+            except Exception as e:
+                elapsed = time.perf_counter() - started
+                self.step_stats[step.name].observe(elapsed, ok=False)
+                STEP_SECONDS.observe(elapsed, step.name, "error")
+                if not step.idempotent and outcome_unknown(e):
+                    raise OutcomeUnknown(f"{type(e).__name__}: {e}") from e
+                if isinstance(e, (StepFailed, DuplicatePurchase)) or attempt == self._step_retry.max_attempts - 1:
+                    raise
+                logging.warning(f"Fulfillment step '{step.name}' of job {job.id} failed, retrying: {e}")
+                await asyncio.sleep(self._step_retry.backoff(attempt))
+            else:
+                elapsed = time.perf_counter() - started
+                self.step_stats[step.name].observe(elapsed, ok=True)
+                STEP_SECONDS.observe(elapsed, step.name, "ok")
+                return
+
+    async def _settle_unknown_outcome(self, step: Step, job: Job, reason: str) -> None:
+        """
+        Deals with a non-idempotent step that may or may not have taken effect, without running it again.
+        """
+        if step.required:
+            # Sending the file again could deliver it twice; support checks with the user instead
+            raise StepFailed(f"Outcome of step '{step.name}' is unknown ({reason}), not repeating it.")
+        logging.warning(f"Fulfillment step '{step.name}' of job {job.id} may not have completed ({reason}); skipping it.")
+        await self._queue.mark_step_done(job, step.name)
+
+    async def _run_steps(self, job: Job) -> None:
+        for step in self._steps:
+            if step.name in job.completed_steps:
+                continue
+            if not step.idempotent:
+                if step.name in job.started_steps:
+                    await self._settle_unknown_outcome(step, job, "an earlier run was interrupted")
+                    continue
+                # Persisted first, so a crash in the middle of the step is noticed by the next run
+                await self._queue.mark_step_started(job, step.name)
+            try:
+                with track_sends() as sends:
+                    await self._run_step(step, job)
+            except asyncio.CancelledError:
+                if not step.idempotent and step.telegram_only and not sends.started:
+                    # Cancelled before anything was sent, so the next run may do the step after all
+                    await self._queue.clear_step_started(job, step.name)
+                raise
+            except OutcomeUnknown as e:
+                await self._settle_unknown_outcome(step, job, str(e))
+                continue
+            except Exception:
+                if not step.idempotent:
+                    # The failure shows the step did not take effect, so the next run may try it again
+                    await self._queue.clear_step_started(job, step.name)
+                raise
+            await self._queue.mark_step_done(job, step.name)
+
+    async def _process(self, job: Job) -> None:
+        user_id = job.payload["user_id"]
+        try:
+            await self._run_steps(job)
+        except DuplicatePurchase as e:
+            # Nothing else may run: the early bird count, the file and the invite link are the other process's
+            self.duplicates += 1
+            logging.warning(f"Fulfillment job {job.id} for user {user_id} skipped: {e}")
+            await self._queue.complete(job)
+            return
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if not isinstance(e, StepFailed) and job.attempts < self._max_attempts:
+                delay = self._retry_delay * (2 ** (job.attempts - 1))
+                self.retried += 1
+                logging.error(f"Fulfillment job {job.id} for user {user_id} failed, retrying in {delay:.0f}s: {error}")
+                await self._queue.retry_later(job, error, delay)
+                return
+            self.failed += 1
+            logging.error(f"Fulfillment job {job.id} for user {user_id} failed permanently: {error}")
+            await self._queue.fail(job, error)
+            try:
+                await self._bot.send_message(user_id, "😔 Произошла ошибка при обработке вашей покупки. Пожалуйста, свяжитесь с поддержкой, и мы все решим.")
+            except Exception as notify_error:
+                logging.error(f"Could not notify user {user_id} about a failed fulfillment: {notify_error}")
+            return
+
+        await self._queue.complete(job)
+        self.completed += 1
+        if "paid_at" in job.payload:
+            FULFILLMENT_SECONDS.observe(time.time() - job.payload["paid_at"])
+        logging.info(f"Fulfillment job {job.id} for user {user_id} completed.")
+
+    async def _release(self, job: Job, error: Exception) -> None:
+        """
+        Puts a job whose run broke off unexpectedly back into the queue for a later run.
+        """
+        try:
+            await self._queue.retry_later(job, f"{type(error).__name__}: {error}", self._retry_delay)
+            logging.warning(f"Fulfillment job {job.id} put back into the queue after an error.")
+        except Exception as e:
+            logging.error(f"Could not put fulfillment job {job.id} back into the queue, will try again: {e}")
+            self._stranded.append(job)
+
+    async def _worker(self) -> None:
+        while not self._stopping:
+            while self._stranded:
+                job = self._stranded.pop()
+                await self._release(job, Exception("the queue was unavailable"))
+                if job in self._stranded:
+                    break
+            if self._stopping:
+                break
+            try:
+                job = await self._queue.claim_next(JOB_KIND)
+            except Exception as e:
+                logging.error(f"Could not read the fulfillment queue: {e}", exc_info=True)
+                job = None
+            if job is None:
+                # Woken up right away by new jobs; the timeout picks up scheduled retries
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(job)
+            except Exception as e:
+                # E.g. the queue failed while recording the outcome; without this the job would stay
+                # 'running' until the next restart
+                logging.error(f"Fulfillment worker error on job {job.id}: {e}", exc_info=True)
+                await self._release(job, e)
+
+    def start(self, bot: Bot) -> None:
+        """
+        Starts the workers. Jobs interrupted by a previous shutdown are picked up again.
+        """
+        self._bot = bot
+        self._stopping = False
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        """
+        Stops taking new jobs and lets the running ones finish within the drain timeout.
+        Jobs still running after it are cancelled and resumed on the next start.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=self._drain_timeout)
+            if pending:
+                logging.warning(f"Cancelling {len(pending)} fulfillment jobs still running after {self._drain_timeout:g}s.")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await blocking_executor.run_io(self._queue.close)
+
+
+# Initialize the fulfillment service instance for global use
+fulfillment = FulfillmentService(
+    queue=JobQueue(FULFILLMENT_QUEUE_PATH),
+    workers=FULFILLMENT_WORKERS,
+    step_attempts=FULFILLMENT_STEP_ATTEMPTS,
+    max_attempts=FULFILLMENT_MAX_ATTEMPTS,
+    retry_delay=FULFILLMENT_RETRY_DELAY,
+    drain_timeout=FULFILLMENT_DRAIN_TIMEOUT,
+)
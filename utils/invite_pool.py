@@ -0,0 +1,192 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (
+    PRIVATE_CHANNEL_ID, INVITE_POOL_SIZE, INVITE_POOL_LOW_WATER, INVITE_LINK_TTL_HOURS,
+    INVITE_LINK_MIN_VALIDITY_HOURS, INVITE_POOL_CREATE_INTERVAL,
+)
+from database.models import InviteLink
+from database.write_behind import write_behind
+
+
+class InviteLinkPool:
+    """
+    A pool of pre-created single-use invite links to the private channel.
+    Links are created in the background at a gentle pace, so a sale spike hands out links from memory
+    instead of hitting the Telegram API (and its flood limits) on the delivery path.
+    Links are created with link_ttl of validity and handed out oldest first; a link is discarded once
+    less than min_validity is left, so every buyer gets a link valid for at least that long.
+    Issued links are recorded in invite_links through the write-behind queue.
+    The pool only lives in memory: discarded links and, on shutdown, the links still in the pool
+    are revoked, so they cannot be used by someone who was never given them.
+    """
+
+    def __init__(
+        self,
+        channel_id: Optional[str],
+        size: int = 50,
+        low_water: int = 20,
+        link_ttl: timedelta = timedelta(hours=48),
+        min_validity: timedelta = timedelta(hours=24),
+        create_interval: float = 1.0,
+    ):
+        """
+        :param channel_id: The channel the links invite to; the pool is disabled without it.
+        :param size: How many links the pool is filled up to.
+        :param low_water: A refill starts when fewer links than this are left.
+        :param link_ttl: Validity of a created link.
+        :param min_validity: Minimal validity left on a link handed out to a buyer.
+        :param create_interval: Pause between two link creations, in seconds.
+        """
+        self._channel_id = channel_id
+        self._size = size
+        self._low_water = low_water
+        self._link_ttl = link_ttl
+        self._min_validity = min_validity
+        self._create_interval = create_interval
+        self._links: Deque[Tuple[str, datetime]] = deque()
+        self._stale: List[str] = []
+        self._bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._refill_needed = asyncio.Event()
+
+        # Metrics
+        self.issued = 0
+        self.fallbacks = 0
+        self.expired = 0
+        self.revoked = 0
+
+    @property
+    def available(self) -> int:
+        return len(self._links)
+
+    def _drop_stale(self) -> None:
+        # Links are created in order, so the ones closest to expiring are on the left
+        deadline = datetime.now() + self._min_validity
+        while self._links and self._links[0][1] <= deadline:
+            self._stale.append(self._links.popleft()[0])
+            self.expired += 1
+
+    async def _create(self) -> Tuple[str, datetime]:
+        expires_at = datetime.now() + self._link_ttl
+        invite_link = await self._bot.create_chat_invite_link(
+            chat_id=self._channel_id,
+            expire_date=expires_at,
+            member_limit=1
+        )
+        return invite_link.invite_link, expires_at
+
+    async def _revoke(self, links: List[str]) -> None:
+        """
+        Revokes unused links. Stops at the first failure; what is left simply expires.
+        """
+        for index, invite_link in enumerate(links):
+            try:
+                await self._bot.revoke_chat_invite_link(chat_id=self._channel_id, invite_link=invite_link)
+            except Exception as e:
+                logging.warning(f"Could not revoke {len(links) - index} unused invite links: {e}")
+                return
+            self.revoked += 1
+
+    def _record(self, workflow_id: int, invite_link: str, expires_at: datetime) -> None:
+        link = InviteLink(workflow_id=workflow_id, invite_link=invite_link, expires_at=expires_at)
+        write_behind.insert("invite_links", {
+            "workflow_id": link.workflow_id,
+            "invite_link": link.invite_link,
+            "expires_at": link.expires_at.isoformat(),
+            "created_at": link.created_at.isoformat(),
+        })
+
+    async def get(self, workflow_id: int) -> Tuple[str, datetime]:
+        """
+        Hands out a single-use invite link for a purchase of a workflow, with its expiry time.
+        Comes from the pool when possible; an empty pool falls back to creating a link right away.
+        """
+        self._drop_stale()
+        if self._links:
+            invite_link, expires_at = self._links.popleft()
+        else:
+            self.fallbacks += 1
+            logging.warning("Invite link pool is empty, creating a link on the delivery path.")
+            invite_link, expires_at = await self._create()
+
+        if len(self._links) < self._low_water:
+            self._refill_needed.set()
+        self.issued += 1
+        self._record(workflow_id, invite_link, expires_at)
+        return invite_link, expires_at
+
+    async def _refill(self) -> None:
+        while len(self._links) < self._size:
+            try:
+                self._links.append(await self._create())
+            except TelegramRetryAfter as e:
+                logging.warning(f"Invite link creation is rate limited, waiting {e.retry_after}s.")
+                await asyncio.sleep(e.retry_after)
+                continue
+            await asyncio.sleep(self._create_interval)
+
+    async def _run(self) -> None:
+        while True:
+            self._drop_stale()
+            if self._stale:
+                stale, self._stale = self._stale, []
+                await self._revoke(stale)
+            if len(self._links) < self._low_water:
+                try:
+                    await self._refill()
+                    logging.info(f"Invite link pool refilled to {len(self._links)} links.")
+                except Exception as e:
+                    logging.error(f"Failed to refill the invite link pool: {e}")
+            self._refill_needed.clear()
+            # Woken up by a low pool; the timeout lets stale links be dropped and replaced
+            try:
+                await asyncio.wait_for(self._refill_needed.wait(), timeout=600)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot) -> None:
+        """
+        Starts filling the pool in the background.
+        """
+        if not self._channel_id:
+            logging.warning("PRIVATE_CHANNEL_ID is not set. The invite link pool is disabled.")
+            return
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the refill and revokes the links nobody was given.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        unused = self._stale + [invite_link for invite_link, _ in self._links]
+        self._stale = []
+        self._links.clear()
+        if unused and self._bot is not None:
+            await self._revoke(unused)
+            logging.info(f"Revoked {self.revoked} unused invite links on shutdown.")
+
+
+# Initialize the invite link pool instance for global use
+invite_pool = InviteLinkPool(
+    channel_id=PRIVATE_CHANNEL_ID,
+    size=INVITE_POOL_SIZE,
+    low_water=INVITE_POOL_LOW_WATER,
+    link_ttl=timedelta(hours=INVITE_LINK_TTL_HOURS),
+    min_validity=timedelta(hours=INVITE_LINK_MIN_VALIDITY_HOURS),
+    create_interval=INVITE_POOL_CREATE_INTERVAL,
+)
@@ -0,0 +1,216 @@
+import inspect
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_PATH
+
+# Seconds; covers everything from an in-memory lookup to a slow Supabase call or a large watermark
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Samples = Union[float, Dict[Tuple[str, ...], float]]
+Collector = Callable[[], Union[Iterable[str], Awaitable[Iterable[str]]]]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labelnames: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def metric_family(name: str, kind: str, documentation: str, samples: Samples, labelnames: Sequence[str] = ()) -> List[str]:
+    """
+    Formats one metric in the Prometheus text format.
+    samples is a single value, or a dict of label values (in labelnames order) -> value.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    if not isinstance(samples, dict):
+        samples = {(): samples}
+    for values, value in samples.items():
+        lines.append(f"{name}{_labels(labelnames, values)} {_number(value)}")
+    return lines
+
+
+class Counter:
+    """
+    A monotonically increasing value per label combination.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """
+        Adds to the counter. Label values are given positionally, in labelnames order.
+        """
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def collect(self) -> List[str]:
+        return metric_family(self.name, "counter", self.documentation, dict(self._values), self.labelnames)
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets per label combination.
+    An observation is a bisect and two additions; buckets are only made cumulative when scraped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket (the last one is +Inf), sum of observed values]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self._buckets) + 1), 0.0]
+        series[0][bisect_left(self._buckets, value)] += 1
+        series[1] += value
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the bot's metrics and renders them in the Prometheus text format.
+    Counters and histograms are updated in place on the hot path; gauges and the counters other
+    components already keep are read by collectors, which only run when the endpoint is scraped.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self._collectors: List[Collector] = []
+
+    def _register(self, metric: Union[Counter, Histogram]) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Collector) -> None:
+        """
+        Adds a function (sync or async) that returns metric lines, e.g. built with metric_family().
+        """
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.collect())
+        for collector in self._collectors:
+            try:
+                result = collector()
+                if inspect.isawaitable(result):
+                    result = await result
+                lines.extend(result)
+            except Exception as e:
+                # One broken collector must not take the whole endpoint down
+                logging.error(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+# Initialize the metrics registry instance for global use
+metrics = MetricsRegistry()
+
+# Shared by every cache, so hit rates can be compared side by side
+cache_requests = metrics.counter(
+    "bot_cache_requests_total", "Cache lookups by cache and result (hit or miss).", ("cache", "result")
+)
+
+
+class MetricsServer:
+    """
+    Serves the registry on an HTTP endpoint for Prometheus to scrape.
+    The endpoint has no authentication, so it is served on its own (private) host and port.
+    aiohttp is imported on start, so importing this module stays cheap for scripts.
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int, path: str):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._path = path
+        self._runner = None
+
+    async def handle(self, request) -> Any:
+        from aiohttp import web
+
+        started = time.perf_counter()
+        body = await self._registry.render()
+        logging.debug(f"Metrics rendered in {time.perf_counter() - started:.4f}s.")
+        return web.Response(body=body.encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self) -> None:
+        """
+        Starts a standalone HTTP server for the endpoint.
+        """
+        from aiohttp import web
+
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get(self._path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self._host, port=self._port).start()
+        logging.info(f"Metrics available on http://{self._host}:{self._port}{self._path}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Initialize the metrics server instance for global use
+metrics_server = MetricsServer(metrics, host=METRICS_HOST, port=METRICS_PORT, path=METRICS_PATH)
@@ -1,31 +1,112 @@
+import asyncio
 import logging
+import time
+from typing import Optional
+
+from config import PRICE_CACHE_TTL
+from database.catalog_cache import STALE_RETRY_INTERVAL
 from database.supabase_http_client import supabase_http_client
+from database.shared_state import GenerationWatcher, shared_state
 
 # --- Prices ---
 PRICE_EARLY_BIRD = 400
 PRICE_REGULAR = 600
 
-async def get_current_price() -> int:
+DEFAULT_EARLY_BIRD_LIMIT = 50
+
+
+class PriceService:
     """
-    Determines the current price based on the Early Bird counter.
+    Keeps the Early Bird counter and limit in memory for a short TTL.
+    Concurrent refreshes are coalesced into a single in-flight request (single-flight),
+    and the counter is bumped locally after each Early Bird sale so the price stays correct without polling.
     """
-    try:
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._counter: Optional[int] = None
+        self._limit: int = DEFAULT_EARLY_BIRD_LIMIT
+        self._loaded_at: Optional[float] = None
+        self._inflight: Optional[asyncio.Task] = None
+        # Notices Early Bird sales recorded by other bot replicas
+        self._watcher = GenerationWatcher(shared_state, "price")
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self._ttl
+
+    async def _fetch(self) -> None:
         # Fetch counter and limit from the settings table
-        settings = await supabase_http_client.select("settings", params={"key": "in.(early_bird_counter,early_bird_limit)"})
-        
+        settings = await supabase_http_client.select("settings", params={"key": "in.(early_bird_counter,early_bird_limit)"}, raise_errors=True)
+
         counter = 0
-        limit = 50 # Default limit
+        limit = DEFAULT_EARLY_BIRD_LIMIT
 
         for setting in settings:
             if setting['key'] == 'early_bird_counter':
                 counter = int(setting['value'])
             elif setting['key'] == 'early_bird_limit':
                 limit = int(setting['value'])
-        
-        if counter <= limit:
+
+        self._counter = counter
+        self._limit = limit
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self) -> None:
+        """
+        Reloads the settings, joining an already running refresh instead of starting a new one.
+        """
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+        # Shield the shared task so a cancelled caller does not cancel it for everyone else
+        await asyncio.shield(self._inflight)
+
+    async def record_early_bird_sale(self, amount: int = 1) -> None:
+        """
+        Applies an Early Bird counter increment locally, right after it was written to the database,
+        and tells other bot replicas to reload the counter.
+        """
+        if self._counter is not None:
+            self._counter += amount
+        await self._watcher.bump()
+
+    def invalidate(self) -> None:
+        """
+        Forces the next price lookup to reload the settings.
+        """
+        self._loaded_at = None
+
+    async def get_current_price(self) -> int:
+        """
+        Determines the current price based on the Early Bird counter.
+        """
+        if await self._watcher.changed():
+            self.invalidate()
+        if not self._is_fresh():
+            try:
+                await self.refresh()
+            except Exception as e:
+                if self._counter is None:
+                    raise
+                # Try again shortly instead of on every lookup while Supabase is failing
+                logging.warning(f"Could not refresh Early Bird settings, serving the last known price. Error: {e}")
+                self._loaded_at = time.monotonic() - self._ttl + STALE_RETRY_INTERVAL
+
+        if self._counter <= self._limit:
             return PRICE_EARLY_BIRD
         else:
             return PRICE_REGULAR
+
+
+# Initialize the price service instance for global use
+price_service = PriceService(ttl=PRICE_CACHE_TTL)
+
+
+async def get_current_price() -> int:
+    """
+    Determines the current price based on the Early Bird counter.
+    """
+    try:
+        return await price_service.get_current_price()
     except Exception as e:
         logging.error(f"Could not determine price from DB, falling back to regular price. Error: {e}")
         return PRICE_REGULAR
@@ -4,59 +4,132 @@ import uuid
 from datetime import datetime
 from zoneinfo import ZoneInfo # For timezone-aware timestamps
 import logging
+from threading import Lock
+from typing import List, Tuple
+
+from cachetools import LRUCache
+
+from config import WATERMARKED_DIR, WATERMARK_TEMPLATE_CACHE_SIZE
+
+
+class WatermarkTemplate:
+    """
+    A pre-serialized workflow document with a splice point for the license section.
+    The workflow is parsed and serialized once; each personalized copy is produced by
+    concatenating the cached bytes with a freshly serialized (tiny) license block.
+    The output is identical to json.dump(workflow_with_license, indent=4, ensure_ascii=False).
+    """
+
+    def __init__(self, workflow_data: dict):
+        # The license always goes last, even if the original file already had one
+        workflow_data = dict(workflow_data)
+        workflow_data.pop('license', None)
+
+        if workflow_data:
+            serialized = json.dumps(workflow_data, indent=4, ensure_ascii=False)
+            # Drop the closing "\n}" so the license can be appended as the last key
+            self._head = serialized[:-2].encode('utf-8') + b',\n    "license": '
+        else:
+            self._head = b'{\n    "license": '
+        self._tail = b'\n}'
+
+    def render(self, license_data: dict) -> bytes:
+        """
+        Returns the full watermarked document for the given license section.
+        """
+        license_json = json.dumps(license_data, indent=4, ensure_ascii=False).replace('\n', '\n    ')
+        return b''.join((self._head, license_json.encode('utf-8'), self._tail))
+
+
+# Templates keyed by (filepath, version); the file's mtime and size detect edits within a version
+_templates = LRUCache(maxsize=WATERMARK_TEMPLATE_CACHE_SIZE)
+_templates_lock = Lock()
+
+
+def get_watermark_template(filepath: str, version: str) -> WatermarkTemplate:
+    """
+    Returns the cached template for a workflow file, parsing the file only when it is new or has changed.
+    """
+    stat = os.stat(filepath)
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    key = (filepath, version)
+
+    with _templates_lock:
+        cached = _templates.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    with open(filepath, 'r', encoding='utf-8') as f:
+        template = WatermarkTemplate(json.load(f))
+
+    with _templates_lock:
+        _templates[key] = (fingerprint, template)
+    logging.info(f"Prepared watermark template for {filepath} (version {version}).")
+    return template
+
+
+def prime_watermark_template(filepath: str, version: str, workflow_data: dict, mtime_ns: int, size: int) -> None:
+    """
+    Caches the template of a workflow that was already parsed elsewhere (e.g. by the catalog sync),
+    so the first purchase does not parse the file again.
+    """
+    with _templates_lock:
+        _templates[(filepath, version)] = ((mtime_ns, size), WatermarkTemplate(workflow_data))
+
+
+def warm_watermark_templates(workflows: List[Tuple[str, str]]) -> None:
+    """
+    Builds the templates of the given (filepath, version) pairs. Files that cannot be read are skipped;
+    delivering them reports the error.
+    """
+    for filepath, version in workflows:
+        try:
+            get_watermark_template(filepath, version)
+        except Exception as e:
+            logging.debug(f"Could not prepare the watermark template for {filepath}: {e}")
+
+
+def get_watermarked_filename(user_id: int, slug: str) -> str:
+    """
+    Creates a unique, human-readable filename for a watermarked workflow.
+    """
+    now_msk = datetime.now(ZoneInfo("Europe/Moscow"))
+    time_str = now_msk.strftime("%Y-%m-%d_%H-%M-%S")
+    return f"{user_id}_{slug}_{time_str}.json"
 
-from config import WATERMARKED_DIR
 
 def add_watermark_to_workflow(
     original_filepath: str,
-    slug: str,
     user_id: int,
     username: str,
     payment_id: str,
     workflow_version: str
-) -> str | None:
+) -> bytes | None:
     """
-    Adds a watermark to a workflow JSON file.
+    Adds a watermark to a workflow JSON file, in memory.
 
     Args:
         original_filepath: Path to the original workflow file.
-        slug: The unique slug of the workflow.
         user_id: The Telegram ID of the user.
         username: The Telegram username of the user.
         payment_id: The payment charge ID from Telegram.
         workflow_version: The version of the workflow being purchased.
 
     Returns:
-        The path to the watermarked file, or None if an error occurred.
+        The watermarked workflow document as UTF-8 bytes, or None if an error occurred.
     """
     try:
-        with open(original_filepath, 'r', encoding='utf-8') as f:
-            workflow_data = json.load(f)
+        template = get_watermark_template(original_filepath, workflow_version)
 
-        # 1. Add the 'license' section
-        workflow_data['license'] = {
+        # Build the 'license' section and splice it into the pre-serialized workflow
+        return template.render({
             "purchased_by": f"TG_USER_ID_{user_id}",
             "username": f"@{username}",
             "purchase_date": datetime.now().isoformat(),
             "payment_id": payment_id,
             "update_token": uuid.uuid4().hex,
             "version": workflow_version,
-        }
-
-        # 2. Create a unique, human-readable filename and save the watermarked file
-        now_msk = datetime.now(ZoneInfo("Europe/Moscow"))
-        time_str = now_msk.strftime("%Y-%m-%d_%H-%M-%S")
-        watermarked_filename = f"{user_id}_{slug}_{time_str}.json"
-        watermarked_filepath = os.path.join(WATERMARKED_DIR, watermarked_filename)
-
-        # Ensure the watermarked directory exists
-        os.makedirs(WATERMARKED_DIR, exist_ok=True)
-
-        with open(watermarked_filepath, 'w', encoding='utf-8') as f:
-            json.dump(workflow_data, f, indent=4, ensure_ascii=False)
-        
-        logging.info(f"Successfully created watermarked file: {watermarked_filepath}")
-        return watermarked_filepath
+        })
 
     except FileNotFoundError:
         logging.error(f"Original workflow file not found at: {original_filepath}")
@@ -64,3 +137,19 @@ def add_watermark_to_workflow(
     except Exception as e:
         logging.error(f"Failed to add watermark to {original_filepath}: {e}", exc_info=True)
         return None
+
+
+def save_watermarked_file(filename: str, data: bytes) -> str:
+    """
+    Saves a copy of a watermarked workflow into WATERMARKED_DIR for auditing.
+    This is blocking file I/O; run it off the event loop.
+
+    Returns:
+        The path to the saved file.
+    """
+    os.makedirs(WATERMARKED_DIR, exist_ok=True)
+    watermarked_filepath = os.path.join(WATERMARKED_DIR, filename)
+    with open(watermarked_filepath, 'wb') as f:
+        f.write(data)
+    logging.info(f"Saved watermarked file for audit: {watermarked_filepath}")
+    return watermarked_filepath